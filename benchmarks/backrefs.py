@@ -0,0 +1,58 @@
+"""
+Benchmark for shipment construction and Shipment.make_backrefs on synthetic
+shipments where volumes (with config files) and doors are shared between containers.
+Reports time and peak memory allocated by make_backrefs.
+
+Usage: python benchmarks/backrefs.py [containers ...]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from dominator import entities
+
+
+def make_containers(size):
+    ships = [entities.Ship('ship{}'.format(i), 'ship{}.example.com'.format(i)) for i in range(max(1, size // 10))]
+    image = entities.Image('image', id='id', namespace=None)
+    files = {'file{}.conf'.format(i): entities.TemplateFile('${this.name} ${value}', value=i, extra={'key': 'value'})
+             for i in range(20)}
+    config = entities.ConfigVolume(dest='/etc/app', files=files)
+    doors = {'http': entities.Door('http', port=80)}
+    return [
+        entities.Container(
+            name='cont{}'.format(i),
+            ship=ships[i % len(ships)],
+            image=image,
+            env={'VAR': str(i)},
+            doors=doors,
+            volumes={'config': config, 'data': entities.DataVolume('/data')},
+        )
+        for i in range(size)
+    ]
+
+
+def main(sizes):
+    print('{:>10} {:>12} {:>14} {:>14}'.format('containers', 'init, ms', 'backrefs, ms', 'peak, MB'))
+    for size in sizes:
+        containers = make_containers(size)
+        start = time.perf_counter()
+        shipment = entities.Shipment('shipment', containers=containers)
+        init = time.perf_counter() - start
+
+        start = time.perf_counter()
+        shipment.make_backrefs()
+        backrefs = time.perf_counter() - start
+
+        # memory is measured separately as tracing slows everything down
+        shipment = entities.Shipment('shipment', containers=make_containers(size))
+        tracemalloc.start()
+        shipment.make_backrefs()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:>10} {:>12.1f} {:>14.1f} {:>14.1f}'.format(size, init * 1000, backrefs * 1000, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
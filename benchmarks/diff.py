@@ -0,0 +1,74 @@
+"""
+Micro-benchmark for container diff engine (utils.compare_container and friends)
+on large synthetic containers.
+
+Usage: python benchmarks/diff.py [size ...]
+"""
+
+import sys
+import timeit
+
+from dominator import entities
+from dominator import utils
+
+
+def make_container(size):
+    ship = entities.Ship('ship', 'ship.example.com', datadir='/data')
+    container = entities.Container(
+        name='cont',
+        ship=ship,
+        image=entities.Image('image', id='expected', namespace=None),
+        command='sleep 10',
+        env={'VAR{}'.format(i): str(i) for i in range(size)},
+        doors={'door{}'.format(i): entities.Door('http', port=10000+i) for i in range(size)},
+        volumes={'volume{}'.format(i): entities.DataVolume('/volume{}'.format(i)) for i in range(size)},
+    )
+    entities.Shipment('shipment', containers=[container]).make_backrefs()
+    return container
+
+
+def make_cinfo(container):
+    volumes = {volume.dest: volume.fullpath for volume in container.volumes.values()}
+    return {
+        'Name': '/' + container.dockername,
+        'Config': {
+            # different image id to not inspect image using docker
+            'Image': 'image:actual',
+            'Memory': 0,
+            'User': '',
+            'Cmd': container.command.split(),
+            'Env': ['{}={}'.format(name, value) for name, value in container.env.items()],
+        },
+        'HostConfig': {
+            'NetworkMode': '',
+            'Privileged': False,
+            'PortBindings': {door.portspec: [{'HostIp': '::', 'HostPort': str(door.externalport)}]
+                             for door in container.doors.values()},
+        },
+        'Volumes': volumes,
+        'VolumesRW': {dest: True for dest in volumes},
+    }
+
+
+def main(sizes):
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format('size', 'env, ms', 'ports, ms', 'volumes, ms', 'total, ms'))
+    for size in sizes:
+        container = make_container(size)
+        cinfo = make_cinfo(container)
+        actualenv = dict(var.split('=', 1) for var in cinfo['Config']['Env'])
+        number = max(1, 10000 // size)
+
+        def measure(func):
+            return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+
+        results = [
+            measure(lambda: utils.compare_env(container.env, actualenv)),
+            measure(lambda: utils.compare_ports(container, cinfo['HostConfig']['PortBindings'])),
+            measure(lambda: utils.compare_volumes(container, cinfo)),
+            measure(lambda: utils.compare_container(container, cinfo)),
+        ]
+        print('{:>8} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}'.format(size, *results))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
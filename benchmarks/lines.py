@@ -0,0 +1,32 @@
+"""
+Throughput benchmark for docker log line splitter (utils.docker_lines)
+on synthetic streams with different line and frame sizes.
+
+Usage: python benchmarks/lines.py [megabytes]
+"""
+
+import sys
+import time
+
+from dominator import utils
+
+
+def make_records(total, linesize, framesize):
+    line = b'x' * (linesize - 1) + b'\n'
+    data = line * (total // linesize)
+    return [data[pos:pos+framesize] for pos in range(0, len(data), framesize)]
+
+
+def main(megabytes):
+    total = megabytes * 1024 * 1024
+    print('{:>10} {:>10} {:>10} {:>12}'.format('line, B', 'frame, B', 'lines', 'MB/s'))
+    for linesize, framesize in [(80, 4096), (80, 65536), (1000, 4096), (65536, 4096), (1024 * 1024, 16384)]:
+        records = make_records(total, linesize, framesize)
+        start = time.perf_counter()
+        count = sum(1 for _ in utils.docker_lines(records))
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>10} {:>10} {:>12.1f}'.format(linesize, framesize, count, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
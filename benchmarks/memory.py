@@ -0,0 +1,79 @@
+"""
+Memory benchmark for entities of large shipments: containers with doors, volumes
+and files. Reports memory allocated for the graph (after make_backrefs) per object
+for slotted entities side by side with the same graph of dict-backed objects
+(entity classes without `__slots__`, as before `entities.Compact`). Both graphs
+are loaded from the same pickle of the built shipment.
+
+Usage: python benchmarks/memory.py [containers]
+"""
+
+import gc
+import io
+import pickle
+import sys
+import tracemalloc
+
+from dominator import entities
+
+
+def make_shipment(size):
+    ships = [entities.Ship('ship{}'.format(i), 'ship{}.example.com'.format(i)) for i in range(max(1, size // 10))]
+    image = entities.Image('image', id='id', namespace=None)
+    return entities.Shipment('shipment', containers=[
+        entities.Container(
+            name='cont{}'.format(i),
+            ship=ships[i % len(ships)],
+            image=image,
+            doors={'door{}'.format(j): entities.Door('http', port=8000+j) for j in range(5)},
+            volumes={
+                'data': entities.DataVolume('/data'),
+                'logs': entities.LogVolume('/logs', files={'app.log': entities.LogFile('%Y-%m-%d')}),
+                'config': entities.ConfigVolume('/etc/app', files={
+                    'file{}.conf'.format(j): entities.TextFile('content') for j in range(10)}),
+            },
+        )
+        for i in range(size)
+    ])
+
+
+class DictUnpickler(pickle.Unpickler):
+    """Loads compact entities as instances of same named classes without `__slots__`"""
+    classes = {}
+
+    def find_class(self, module, name):
+        cls = super().find_class(module, name)
+        if isinstance(cls, type) and issubclass(cls, entities.Compact):
+            if cls not in self.classes:
+                self.classes[cls] = type(name, (), {})
+            return self.classes[cls]
+        return cls
+
+
+def measure(load):
+    # garbage of previous measurements should not be freed during this one
+    gc.collect()
+    tracemalloc.start()
+    shipment = load()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return shipment, allocated
+
+
+def main(size):
+    shipment = make_shipment(size)
+    shipment.make_backrefs()
+    objects = sum(1 + len(c.doors) + len(c.volumes) for c in shipment.containers) + len(list(shipment.files))
+    data = pickle.dumps(shipment, pickle.HIGHEST_PROTOCOL)
+    del shipment
+
+    print('containers: {}, objects: {}'.format(size, objects))
+    print('{:>20} {:>15} {:>15}'.format('layout', 'allocated, MB', 'per object, B'))
+    for layout, loader in [('slots', pickle.loads), ('dict', lambda data: DictUnpickler(io.BytesIO(data)).load())]:
+        loaded, allocated = measure(lambda: loader(data))
+        print('{:>20} {:>15.1f} {:>15.0f}'.format(layout, allocated / 1024 / 1024, allocated / objects))
+        del loaded
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
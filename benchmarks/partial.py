@@ -0,0 +1,60 @@
+"""
+Benchmark for loading shipment from YAML, from compiled cache and partially
+(single ship, as for `container -p 'ship0:*'`) on synthetic shipment.
+
+Usage: python benchmarks/partial.py [ships [containers per ship]]
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+from dominator import actions
+from dominator import entities
+from dominator import utils
+
+
+def make_shipment(ships, containers):
+    image = entities.Image('image', id='id', namespace=None)
+    return entities.Shipment('shipment', containers=[
+        entities.Container(
+            name='cont{}'.format(i),
+            ship=ship,
+            image=image,
+            env={'VAR{}'.format(j): str(j) for j in range(20)},
+            doors={'http': entities.Door('http', port=80)},
+            volumes={'config': entities.ConfigVolume(dest='/etc/app', files={
+                'file{}.conf'.format(j): entities.TextFile('line\n' * 50) for j in range(5)})},
+        )
+        for ship in [entities.Ship('ship{}'.format(i), 'ship{}.example.com'.format(i)) for i in range(ships)]
+        for i in range(containers)
+    ])
+
+
+def measure(path, pattern):
+    # garbage of previous measurements should not be collected during this one
+    gc.collect()
+    start = time.perf_counter()
+    with open(path) as file:
+        shipment = actions.ShipmentFile(file).load(pattern)
+    return time.perf_counter() - start, len(list(shipment.containers))
+
+
+def main(ships, containers):
+    with tempfile.TemporaryDirectory() as tempdir:
+        utils.settings['cachedir'] = tempdir
+        path = os.path.join(tempdir, 'shipment.yaml')
+        with open(path, 'w') as file:
+            yaml.dump(make_shipment(ships, containers), file)
+
+        print('{:>30} {:>10} {:>12}'.format('load', 'time, s', 'containers'))
+        for title, pattern in [('yaml (no cache)', '*'), ('full cache', '*'), ('single ship cache', 'ship0:*')]:
+            print('{:>30} {:>10.3f} {:>12}'.format(title, *measure(path, pattern)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]] or [100, 50])
@@ -0,0 +1,76 @@
+"""
+Startup time benchmark for dominator command line: runs `--help` and cached
+`container list` in fresh interpreters and compares median time spent on top of
+importing third-party dependencies (click, PyYAML, colorama, logging.config), which
+every command needs, with targets. Absolute times depend on machine, so they are
+shown for reference only. Package is byte-compiled first, as it is when installed.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+
+import compileall
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from dominator import entities
+
+# Targets for median wall time of a command on top of dependencies import, seconds
+TARGETS = {
+    '--help': 0.1,
+    'container list': 0.15,
+}
+DEPENDENCIES = 'import click, yaml, colorama, logging.config'
+
+
+def make_shipment(containers):
+    ship = entities.Ship('ship0', 'ship0.example.com')
+    image = entities.Image('image', id='id', namespace=None)
+    return entities.Shipment('shipment', containers=[
+        entities.Container(name='cont{}'.format(i), ship=ship, image=image, doors={'http': entities.Door('http')})
+        for i in range(containers)
+    ])
+
+
+def measure(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable] + args, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(runs):
+    with tempfile.TemporaryDirectory() as tempdir:
+        settingspath = os.path.join(tempdir, 'settings.yaml')
+        with open(settingspath, 'w') as file:
+            yaml.dump({'cachedir': os.path.join(tempdir, 'cache'), 'logging': {'version': 1}}, file)
+        configpath = os.path.join(tempdir, 'shipment.yaml')
+        with open(configpath, 'w') as file:
+            yaml.dump(make_shipment(10), file)
+
+        commands = {
+            '--help': ['--help'],
+            'container list': ['-s', settingspath, '-c', configpath, 'container', 'list'],
+        }
+        compileall.compile_dir(os.path.dirname(os.path.dirname(entities.__file__)), quiet=1)
+        # fill shipment cache first
+        measure(['-m', 'dominator.actions'] + commands['container list'], 1)
+
+        base = measure(['-c', DEPENDENCIES], runs)
+        print('dependencies import: {:.3f}s'.format(base))
+        print('{:>20} {:>10} {:>12} {:>10} {:>6}'.format('command', 'time, s', 'overhead, s', 'target, s', ''))
+        for title, args in commands.items():
+            elapsed = measure(['-m', 'dominator.actions'] + args, runs)
+            print('{:>20} {:>10.3f} {:>12.3f} {:>10.3f} {:>6}'.format(
+                title, elapsed, elapsed - base, TARGETS[title], 'ok' if elapsed - base <= TARGETS[title] else 'SLOW'))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]] or [5])
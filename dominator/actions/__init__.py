@@ -1,18 +1,26 @@
 import logging
 import logging.config
 import os
-import pkg_resources
+import sys
 import datetime
 import fnmatch
 import re
+import copy
 import functools
+import hashlib
+import importlib
+import time
+import queue
+import threading
+import urllib.parse
 
 import yaml
-import mako.template
 from colorama import Fore
 import click
 
-from ..entities import SourceImage, BaseShip, BaseFile, Volume, Container, Shipment
+from ..entities import SourceImage, BaseShip, BaseFile, Volume, Container, Shipment, LogFile, EVENT_STATUSES, \
+    collectlogs
+from .. import entities
 from .. import utils
 
 
@@ -36,12 +44,31 @@ def validate_loglevel(ctx, param, value):
         raise click.BadParameter('loglevel should be logging level name or number')
 
 
+def validate_since(ctx, param, value):
+    """Converts unix timestamp or duration ago (like 30s, 10m, 2h, 1d) to unix timestamp"""
+    if value is None:
+        return None
+    match = re.match(r'^(\d+)([smhd]?)$', value)
+    if not match:
+        raise click.BadParameter('since should be unix timestamp or duration like 10m, 2h, 1d')
+    number, unit = match.groups()
+    if not unit:
+        return int(number)
+    return int(time.time()) - int(number) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+
+
+def validate_tail(ctx, param, value):
+    if value != 'all' and not value.isdigit():
+        raise click.BadParameter('tail should be number of lines or "all"')
+    return value if value == 'all' else int(value)
+
+
 @click.group()
 @click.option('-c', '--config', type=click.File('r'), help="file path to load config from")
 @click.option('-s', '--settings', type=click.File('r'), help="file path to load settings from")
 @click.option('-n', '--namespace', help="override docker namespace from settings")
 @click.option('-l', '--loglevel', callback=validate_loglevel, default='warn')
-@click.version_option()
+@click.version_option(utils.__version__)
 @click.pass_context
 def cli(ctx, config, loglevel, settings, namespace):
     logging.basicConfig(level=loglevel)
@@ -50,52 +77,251 @@ def cli(ctx, config, loglevel, settings, namespace):
         utils.settings.set('docker.namespace', namespace)
     logging.config.dictConfig(utils.settings.get('logging', {}))
     logging.disable(level=loglevel-1)
+    ctx.call_on_close(utils.templates.logstats)
 
     if config is not None:
-        shipment = yaml.load(config)
-        shipment.make_backrefs()
-        ctx.obj = shipment
+        ctx.obj = ShipmentFile(config)
+
+
+def loadshipment(file):
+    return ShipmentFile(file).load()
+
+
+class ShipmentFile:
+    """Shipment YAML file. Built shipment is cached (see `utils.loadcache`) by file digest and dominator
+    version, so unchanged file is loaded without YAML parsing and `make_backrefs`. Cache is also outdated
+    by modification of dominator modules or modules of classes used in the file (see `getmodulefiles`).
+    Cache is also split by ship to load only ships needed by filtered commands, see `load`.
+    """
+    def __init__(self, file):
+        self.name = file.name
+        self.content = file.read()
+        self.key = (utils.__version__, hashlib.sha256(self.content.encode()).hexdigest())
+        self.cachedir = utils.getcachepath('shipments', hashlib.sha1(os.path.abspath(file.name).encode()).hexdigest())
+        self.shipment = None
+
+    def getcachepath(self, name):
+        return os.path.join(self.cachedir, name)
+
+    def getshipcachepath(self, shipname):
+        return self.getcachepath('ship.' + urllib.parse.quote(shipname, safe=''))
+
+    def loadfull(self):
+        if self.shipment is None:
+            shipment = utils.loadcache(self.getcachepath('shipment'), self.key)
+            if shipment is None:
+                utils.getlogger().debug('loading shipment from yaml', file=self.name)
+                shipment = yaml.load(self.content, Loader=utils.YamlLoader)
+                shipment.make_backrefs()
+                utils.savecache(self.getcachepath('shipment'), self.key, shipment, self.getmodulefiles())
+                self.savesplit(shipment)
+            self.shipment = shipment
+        return self.shipment
+
+    def getmodulefiles(self):
+        """Returns files of dominator modules and of modules with classes referenced by YAML tags
+        (e.g. entities subclassed by obedients) of loaded file, so pickled shipment depends on them
+        """
+        modules = {entities.__name__, utils.__name__, __name__}
+        for name in re.findall(r'python/(?:object/new|object/apply|object|name|module):([\w.]+)', self.content):
+            # tag contains module name followed by (possibly nested) class name
+            while name and name not in sys.modules:
+                name = name.rpartition('.')[0]
+            if name:
+                modules.add(name)
+        return sorted(filter(None, (getattr(sys.modules[name], '__file__', None) for name in modules)))
+
+    def savesplit(self, shipment):
+        """Saves cache of every ship as separate shipment with only this ship. Shipment isn't split if
+        objects of some ship refer to other ships (e.g. template context refers to their containers),
+        as such partial shipment would pull the whole graph and filtered commands would render it differently.
+        """
+        import pickle
+        if len(shipment.ships) < 2:
+            return
+        partials = {}
+        for name, ship in shipment.ships.items():
+            partial = copy.copy(shipment)
+            partial.ships = {name: ship}
+            partial.tasks = [task for task in shipment.tasks if task.ship is ship]
+            # backref is switched to not pickle other ships along with this one
+            ship.shipment = partial
+            try:
+                partials[name] = dumpship(partial, ship)
+            except pickle.PicklingError as e:
+                utils.getlogger().debug('not splitting shipment cache', file=self.name, reason=str(e))
+                return
+            finally:
+                ship.shipment = shipment
+        files = self.getmodulefiles()
+        for name, data in partials.items():
+            utils.savecache(self.getshipcachepath(name), self.key, data, files)
+        # ship list is saved last, so all ships are saved if it's found
+        utils.savecache(self.getcachepath('ships'), self.key, list(shipment.ships))
+
+    def load(self, pattern='*', regex=False):
+        """Returns shipment with ships which objects with fullnames matching `pattern` could belong to
+        (whole shipment for regex or if all ships could match). Objects of loaded ships don't refer to
+        other ships (see `savesplit`), but shipment listings (`ships`, `containers`, `tasks`, etc.) contain
+        only loaded ships, so it should be used only by commands which don't render or change anything.
+        Full shipment is available with `loadfull`.
+        """
+        import pickle
+        names = None if regex or self.shipment is not None else utils.loadcache(self.getcachepath('ships'), self.key)
+        if names is not None:
+            # Fullnames start with ship name, so ship should match literal prefix of pattern
+            selected = utils.selectsegments(names, pattern)
+            if 0 < len(selected) < len(names):
+                utils.getlogger().debug('loading shipment partially', file=self.name, ships=selected)
+                partials = [utils.loadcache(self.getshipcachepath(name), self.key) for name in selected]
+                if None not in partials:
+                    shipment = pickle.loads(partials[0])
+                    for data in partials[1:]:
+                        partial = pickle.loads(data)
+                        for ship in partial.ships.values():
+                            ship.shipment = shipment
+                        shipment.ships.update(partial.ships)
+                        shipment.tasks.extend(partial.tasks)
+                    return shipment
+        return self.loadfull()
+
+
+def dumpship(shipment, ship):
+    """Pickles partial shipment of `ship`, raises `pickle.PicklingError` if it refers to other ships"""
+    import io
+    import pickle
+
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            if isinstance(obj, BaseShip) and obj is not ship:
+                raise pickle.PicklingError('reference to ship {}'.format(obj.name))
+            return None
+
+    stream = io.BytesIO()
+    Pickler(stream, pickle.HIGHEST_PROTOCOL).dump(shipment)
+    return stream.getvalue()
+
+
+class ObjectGroup(click.Group):
+    """Group of commands working on filtered shipment objects. It remembers its arguments to tell
+    whether all invoked commands are `readonly`, so only ships needed by them can be loaded.
+    """
+    def parse_args(self, ctx, args):
+        ctx.rawargs = list(args)
+        return super().parse_args(ctx, args)
+
+    def isreadonly(self, ctx):
+        # chained commands aren't parsed yet, so every argument naming a command is checked
+        return all(getattr(command, 'readonly', False)
+                   for name, command in self.commands.items() if name in ctx.rawargs)
+
+
+def readonly(command):
+    """Marks command which neither renders nor changes objects, so it can get partial shipment"""
+    command.readonly = True
+    return command
+
+
+def getshipment(obj, pattern='*', regex=False, readonly=False):
+    """Returns shipment from context object. If it's `ShipmentFile`, only ships needed for
+    filtering objects by `pattern` are loaded for `readonly` commands.
+    """
+    if isinstance(obj, ShipmentFile):
+        return obj.load(pattern, regex) if readonly else obj.loadfull()
+    return obj
+
+
+def echo_yaml(data, output=None, **kwargs):
+    """Writes YAML document to `output` file or to stdout. Document is written to file as it is being
+    emitted, so it is never kept in memory as a whole. Pager is used only if stdout is a terminal.
+    """
+    if output is None:
+        if sys.stdout.isatty():
+            click.echo_via_pager(yaml.dump(data, **kwargs))
+            return
+        output = sys.stdout
+    yaml.dump(data, output, **kwargs)
 
 
 @cli.group(chain=True)
-def shipment():
+@click.pass_context
+def shipment(ctx):
     """Shipment management commands."""
     utils.setcontext(logger=logging.getLogger('dominator.shipment'))
+    ctx.obj = getshipment(ctx.obj)
+
+
+@utils.cached
+def getobedientindex():
+    """Returns entrypoints ('module:attrs') of all installed obedient distributions by distribution
+    and entrypoint names. Scanning all distributions is slow, so index is cached on disk until
+    some directory in `sys.path` is modified (e.g. by installation or removal of a package).
+    """
+    key = [(path, os.path.getmtime(path)) for path in sys.path if os.path.isdir(path)]
+    path = utils.getcachepath('obedients')
+    index = utils.loadcache(path, key)
+    if index is None:
+        import pkg_resources
+        getlogger().debug('scanning installed distributions for obedients')
+        index = {}
+        environment = pkg_resources.Environment()
+        for pkgname in environment:
+            if pkgname.startswith('obedient.'):
+                # distributions of project are sorted by version, newest first
+                entrymap = environment[pkgname][0].get_entry_map('obedient')
+                index[pkgname] = {name: '{}:{}'.format(entrypoint.module_name, '.'.join(entrypoint.attrs))
+                                  for name, entrypoint in entrymap.items()}
+        utils.savecache(path, key, index)
+    return index
 
 
 def getobedients():
-    return [pkgname for pkgname in pkg_resources.Environment() if pkgname.startswith('obedient.')]
+    return sorted(getobedientindex())
+
+
+def loadentrypoint(entrypoint):
+    """Imports object referenced by entrypoint in 'module:attrs' format"""
+    modulename, _, attrs = entrypoint.partition(':')
+    obj = importlib.import_module(modulename)
+    for attr in attrs.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def validate_obedient(ctx, param, value):
+    # validated here instead of click.Choice to not scan all installed distributions on every run
+    if value is not None and value not in getobedientindex():
+        raise click.BadParameter('distribution should be one of: {}'.format(', '.join(getobedients())))
+    return value
 
 
 @shipment.command()
 @click.pass_context
-@click.argument('distribution', required=False, type=click.Choice(getobedients()), metavar='<distribution>')
+@click.argument('distribution', required=False, callback=validate_obedient, metavar='<distribution>')
 @click.argument('entrypoint', required=False, metavar='<entrypoint>')
 @click.option('--cache/--no-cache', default=True)
 @click.option('--clear-cache', is_flag=True, default=False, help="clear requests_cache before run (requires --cache)")
-def generate(ctx, distribution, entrypoint, cache, clear_cache):
+@click.option('-o', '--output', type=click.File('w'), help="file to write config to ('-' for stdout without pager)")
+def generate(ctx, distribution, entrypoint, cache, clear_cache, output):
     """Generates yaml config file for shipment."""
     if distribution is None:
         click.echo('\n'.join(getobedients()))
         ctx.exit()
 
-    dist = pkg_resources.get_distribution(distribution)
+    entrypoints = getobedientindex()[distribution]
 
     if entrypoint is None:
         # Show all "obedient" entrypoints for package
-        for entrypoint in dist.get_entry_map('obedient').keys():
+        for entrypoint in entrypoints.keys():
             click.echo(entrypoint)
         ctx.exit()
 
     getlogger().info("generating config", distribution=distribution, entrypoint=entrypoint)
 
-    assert dist is not None, "Could not load distribution for {}".format(distribution)
-
-    if entrypoint is None:
-        entrypoint = list(dist.get_entry_map('obedient').keys())[0]
-        getlogger().debug("autodetected entrypoint is %s", entrypoint)
-
-    func = dist.load_entry_point('obedient', entrypoint)
+    if entrypoint not in entrypoints:
+        raise click.BadParameter('entrypoint should be one of: {}'.format(', '.join(entrypoints)),
+                                 param_hint='entrypoint')
+    func = loadentrypoint(entrypoints[entrypoint])
     assert func is not None, "Could not load entrypoint {} from distribution {}".format(entrypoint, distribution)
 
     import pkginfo
@@ -129,7 +355,7 @@ def generate(ctx, distribution, entrypoint, cache, clear_cache):
                     if image.getid() is None:
                         raise RuntimeError("Could not find id for image {}".format(image))
 
-    click.echo_via_pager(yaml.dump(shipment))
+    echo_yaml(shipment, output)
 
 
 @shipment.command()
@@ -140,6 +366,7 @@ def generate(ctx, distribution, entrypoint, cache, clear_cache):
 @click.option('-t', '--target', type=click.Path(), default='./', help="target directory to create debian/ inside")
 def makedeb(shipment, packagename, distribution, urgency, target):
     """Generate debian/ directory to make a .deb."""
+    import pkg_resources
 
     def render_dir(name):
         os.makedirs(os.path.join(target, name))
@@ -148,8 +375,7 @@ def makedeb(shipment, packagename, distribution, urgency, target):
             if pkg_resources.resource_isdir(__name__, path):
                 render_dir(path)
             else:
-                filename = pkg_resources.resource_filename(__name__, path)
-                template = mako.template.Template(filename=filename)
+                template = utils.templates.get(pkg_resources.resource_string(__name__, path).decode())
                 utils.getlogger().debug("rendering file %s", path)
                 rendered = template.render(
                     packagename=packagename,
@@ -163,7 +389,174 @@ def makedeb(shipment, packagename, distribution, urgency, target):
     render_dir('debian')
 
     with open(os.path.join(target, 'debian', '{}.yaml'.format(packagename)), 'w+') as config:
-        yaml.dump(shipment, config)
+        echo_yaml(shipment, config)
+
+
+ACTION_COLORS = {'create': Fore.GREEN, 'recreate': Fore.RED, 'rerender': Fore.YELLOW, 'noop': ''}
+
+
+@shipment.command()
+@click.pass_obj
+@click.option('-p', '--pattern', default='*', help="pattern to filter ship:container")
+@click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
+@click.option('-d', '--showdiff', is_flag=True, default=False, help="show diff with running containers")
+@click.option('-o', '--output', type=click.File('w'), help="file to save plan to")
+def plan(shipment, pattern, regex, showdiff, output):
+    """Show actions needed to bring containers to requested state."""
+    steps = shipment.plan(shipment.getindex('containers').filter(pattern, regex), full=showdiff)
+    for cont, action, diff in steps:
+        click.echo('{color}{action:10.10}{reset} {cont.fullname}'.format(
+            color=ACTION_COLORS[action], action=action, reset=Fore.RESET, cont=cont))
+        if showdiff:
+            print_diff(diff)
+    if output is not None:
+        yaml.safe_dump({
+            'shipment': shipment.name,
+            'actions': {cont.fullname: action for cont, action, _ in steps},
+        }, output, default_flow_style=False)
+
+
+@shipment.command()
+@click.pass_obj
+@click.option('-p', '--pattern', default='*', help="pattern to filter ship:container")
+@click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
+@click.argument('planfile', required=False, type=click.File('r'))
+def apply(shipment, pattern, regex, planfile):
+    """Execute actions saved by `plan` (or computed now) in parallel."""
+    containers = shipment.getindex('containers').filter(pattern, regex)
+    if planfile is None:
+        steps = [(cont, action) for cont, action, _ in shipment.plan(containers)]
+    else:
+        saved = yaml.safe_load(planfile)
+        if saved['shipment'] != shipment.name:
+            raise click.BadParameter('plan is made for shipment {}'.format(saved['shipment']), param_hint='planfile')
+        steps = [(cont, saved['actions'][cont.fullname]) for cont in containers if cont.fullname in saved['actions']]
+        shipment.check(cont for cont, _ in steps)
+    steps = [(cont, action) for cont, action in steps if action != 'noop']
+
+    def execute(step):
+        cont, action = step
+        with utils.addcontext(logger=logging.getLogger('dominator.container'), container=cont):
+            cont.apply(action)
+
+    utils.parallel(execute, steps)
+    for cont, action in steps:
+        click.echo('{color}{action:10.10}{reset} {cont.fullname}'.format(
+            color=ACTION_COLORS[action], action=action, reset=Fore.RESET, cont=cont))
+
+
+@shipment.command('diff')
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+@click.option('-d', '--showdiff', is_flag=True, default=False, help="show diff for changed containers")
+@click.option('-f', '--format', 'fmt', type=click.Choice(['status', 'list', 'regex']), default='status',
+              help="output format, list and regex print added and changed containers for `container -p`")
+def diff_shipments(old, new, showdiff, fmt):
+    """Compare two shipment files without contacting ships."""
+    oldcontainers = {cont.fullname: cont for cont in loadshipment(old).containers}
+    newcontainers = {cont.fullname: cont for cont in loadshipment(new).containers}
+    changes = []
+    for name in sorted(set(oldcontainers).union(newcontainers)):
+        if name not in newcontainers:
+            changes.append((name, 'removed', []))
+        elif name not in oldcontainers:
+            changes.append((name, 'added', []))
+        else:
+            diff = utils.compare_definitions(oldcontainers[name], newcontainers[name])
+            if diff:
+                changes.append((name, 'changed', diff))
+
+    names = [name for name, change, _ in changes if change != 'removed']
+    if fmt == 'list':
+        for name in names:
+            click.echo(name)
+    elif fmt == 'regex':
+        # (?!) never matches, so empty diff does not turn into "match everything" pattern
+        click.echo('^({})$'.format('|'.join(re.escape(name) for name in names)) if names else '(?!)')
+    else:
+        colors = {'removed': Fore.RED, 'added': Fore.GREEN, 'changed': Fore.YELLOW}
+        for name, change, diff in changes:
+            click.echo('{}{:10.10}{} {}'.format(colors[change], change, Fore.RESET, name))
+            if showdiff:
+                print_diff(diff)
+
+
+# Docker events after which container should be reconciled
+RECONCILE_EVENTS = {'die', 'destroy'}
+
+
+@shipment.command()
+@click.pass_obj
+@click.option('-p', '--pattern', default='*', help="pattern to filter ship:container")
+@click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
+@click.option('-w', '--workers', default=4, help="number of containers reconciled at once")
+@click.option('--rate', default=5.0, help="max number of containers reconciled per second")
+@click.option('--resync', default=300.0, help="interval in seconds between reconciling all containers")
+@click.option('--stats', 'stats_interval', default=60.0, help="interval in seconds between stats reports")
+def reconcile(shipment, pattern, regex, workers, rate, resync, stats_interval):
+    """Continuously keep containers in requested state."""
+    containers = shipment.getindex('containers').filter(pattern, regex)
+    ships = {cont.ship.name: cont.ship for cont in containers}
+    watched = set(containers)
+    work = utils.WorkQueue(rate)
+    lock = threading.Lock()
+    stats = {'processed': 0, 'failed': 0, 'latency': 0.0, 'maxlatency': 0.0}
+
+    def listen(ship, since):
+        with utils.addcontext(logger=logging.getLogger('dominator.ship'), ship=ship):
+            for event in ship.events(since):
+                if event.get('status') in RECONCILE_EVENTS:
+                    cont = ship.getcontainer(event)
+                    if cont in watched:
+                        getlogger().info('container event, enqueueing', event=event['status'], container=cont)
+                        work.put(cont)
+
+    def resyncer():
+        while True:
+            getlogger().debug('resyncing all containers')
+            for cont in containers:
+                work.put(cont)
+            time.sleep(resync)
+
+    def worker():
+        while True:
+            cont, queued = work.get()
+            with utils.addcontext(logger=logging.getLogger('dominator.container'), container=cont):
+                failed = False
+                try:
+                    cont.run()
+                except Exception:
+                    failed = True
+                    getlogger().exception('failed to reconcile container')
+                finally:
+                    work.done(cont)
+            latency = time.time() - queued
+            with lock:
+                stats['processed'] += 1
+                stats['failed'] += failed
+                stats['latency'] += latency
+                stats['maxlatency'] = max(stats['maxlatency'], latency)
+
+    since = int(time.time())
+    threads = [threading.Thread(target=listen, args=(ship, since)) for ship in ships.values()]
+    threads.append(threading.Thread(target=resyncer))
+    threads.extend(threading.Thread(target=worker) for _ in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            time.sleep(stats_interval)
+            with lock:
+                report = dict(stats, queue=len(work))
+                report['latency'] = stats['latency'] / stats['processed'] if stats['processed'] else 0.0
+                stats.update(processed=0, failed=0, latency=0.0, maxlatency=0.0)
+            click.echo('{time} queue={queue} processed={processed} failed={failed} '
+                       'latency={latency:.2f}s maxlatency={maxlatency:.2f}s'.format(
+                           time=datetime.datetime.now().strftime('%H:%M:%S'), **report))
+    except KeyboardInterrupt:
+        pass
 
 
 @shipment.command()
@@ -183,14 +576,14 @@ def objgraph(shipment, filename):
     objgraph.show_refs(shipment, filename=filename, max_depth=14, filter=filter_entities, highlight=highlight)
 
 
-@cli.group(chain=True)
+@cli.group(chain=True, cls=ObjectGroup)
 @click.pass_context
 @click.option('-p', '--pattern', default='*', help="pattern to filter ship:container")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 def container(ctx, pattern, regex):
     """Container management commands."""
-    shipment = ctx.obj
-    ctx.obj = filterbyname(shipment.containers, pattern, regex)
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('containers').filter(pattern, regex)
 
 
 def foreach(varname):
@@ -207,23 +600,71 @@ def foreach(varname):
 
 @container.command()
 @click.pass_obj
+@click.option('-f', '--fast-swap', is_flag=True, default=False,
+              help="prepare replacement container before stopping running one")
 @foreach('container')
-def start(cont):
+def start(cont, fast_swap):
     """Push images, render config volumes and Start containers."""
-    cont.run()
+    downtime = cont.run(fast_swap)
+    if downtime is not None:
+        click.echo('{:60.60} downtime {:.2f}s'.format(cont.fullname, downtime))
 
 
 @container.command()
 @click.pass_obj
-@foreach('container')
-def restart(cont):
+@click.option('--rolling', is_flag=True, default=False,
+              help="restart in waves grouped by datacenter, waiting for doors to answer")
+@click.option('-u', '--max-unavailable', default=1, help="max containers restarted at once in rolling mode")
+@click.option('-t', '--timeout', default=60.0, help="seconds to wait for doors to answer in rolling mode")
+def restart(containers, rolling, max_unavailable, timeout):
     """Restart containers."""
+    if rolling:
+        rolling_restart(containers, max_unavailable, timeout)
+    else:
+        restart_container(containers)
+
+
+@foreach('container')
+def restart_container(cont):
     cont.check()
     if cont.running:
         cont.stop()
     cont.run()
 
 
+def rolling_restart(containers, max_unavailable, timeout):
+    def restart_and_probe(cont):
+        with utils.addcontext(logger=logging.getLogger('dominator.container'), container=cont):
+            restart_container([cont])
+            try:
+                return cont.waitready(timeout)
+            except TimeoutError as e:
+                getlogger().error('container did not become ready', error=e)
+                return None
+
+    waves = []
+    for datacenter, conts in utils.groupbysorted(containers, key=lambda c: getattr(c.ship, 'datacenter', None) or ''):
+        conts = list(conts)
+        for pos in range(0, len(conts), max_unavailable):
+            waves.append((datacenter, conts[pos:pos+max_unavailable]))
+
+    failed = []
+    for num, (datacenter, wave) in enumerate(waves, 1):
+        started = time.time()
+        results = utils.parallel(restart_and_probe, wave)
+        click.echo('wave {}/{} {:15.15} {:.1f}s'.format(num, len(waves), datacenter or '-', time.time() - started))
+        for cont, latencies in zip(wave, results):
+            if latencies is None:
+                failed.append(cont)
+                click.echo('  {:60.60} {}not ready{}'.format(cont.fullname, Fore.RED, Fore.RESET))
+            else:
+                doors = ' '.join('{}={:.2f}s'.format(name, latency) for name, latency in sorted(latencies.items()))
+                click.echo('  {:60.60} {}ready{} {}'.format(cont.fullname, Fore.GREEN, Fore.RESET, doors))
+        if failed:
+            raise click.ClickException('stopping rolling restart, containers are not ready: {}'.format(
+                ', '.join(cont.fullname for cont in failed)))
+
+
 @container.command('exec')
 @click.pass_obj
 @click.option('-k', '--keep', is_flag=True, default=False, help="keep container after stop")
@@ -265,6 +706,7 @@ def remove(cont):
     cont.remove()
 
 
+@readonly
 @container.command('list')
 @click.pass_obj
 @foreach('container')
@@ -276,22 +718,50 @@ def container_list(container):
 @container.command()
 @click.pass_obj
 @click.option('-d', '--showdiff', is_flag=True, default=False, help="show diff with running container")
-@foreach('container')
-def status(c, showdiff):
+@click.option('-m', '--max-age', type=float, help="use locally cached state if it's not older than given seconds")
+def status(containers, showdiff, max_age):
     """Show container status."""
-    c.check()
-    if c.running:
-        diff = list(utils.compare_container(c, c.inspect()))
-        if len(diff) > 0:
-            color = Fore.YELLOW
+    containers = list(containers)
+    if not containers:
+        return
+    shipment = containers[0].ship.shipment
+    cache = None
+    if max_age is not None:
+        cache = utils.StateCache(utils.getcachepath('status', shipment.name + '.json'))
+
+    states = {}
+    stale = []
+    for c in containers:
+        entry = cache.get(c.fullname, max_age) if cache is not None and not showdiff else None
+        if entry is not None and entry['fingerprint'] == c.getfingerprint():
+            c.check({'Id': entry['id'], 'Status': entry['status']})
+            states[c] = entry['drifted'], [], time.time() - entry['timestamp']
         else:
-            color = Fore.GREEN
-    else:
-        color = Fore.RED
-    click.echo('{c.fullname:60.60} {color}{id:10.7} {c.status:30.30}{reset}'
-               .format(c=c, color=color, id=c.id or '', reset=Fore.RESET))
-    if c.running and showdiff:
-        print_diff(diff)
+            stale.append(c)
+
+    def getdiff(c):
+        with utils.addcontext(logger=logging.getLogger('dominator.container'), container=c):
+            return list(c.getdiff(full=showdiff)) if c.running else []
+
+    shipment.check(stale)
+    for c, diff in zip(stale, utils.parallel(getdiff, stale)):
+        states[c] = len(diff) > 0, diff, None
+        if cache is not None:
+            cache.set(c.fullname, id=c.id, status=c.status, fingerprint=c.getfingerprint(), drifted=len(diff) > 0)
+    if cache is not None:
+        cache.save()
+
+    for c in containers:
+        drifted, diff, age = states[c]
+        if c.running:
+            color = Fore.YELLOW if drifted else Fore.GREEN
+        else:
+            color = Fore.RED
+        click.echo('{c.fullname:60.60} {color}{id:10.7} {c.status:30.30}{reset}{age}'.format(
+            c=c, color=color, id=c.id or '', reset=Fore.RESET,
+            age='' if age is None else ' (cached {:.0f}s ago)'.format(age)))
+        if c.running and showdiff:
+            print_diff(diff)
 
 
 def print_diff(difflist):
@@ -311,21 +781,94 @@ def print_diff(difflist):
             assert False, "invalid diff format for {key}: {diff}".format(**locals())
 
 
+@readonly
 @container.command()
 @click.pass_obj
-@click.option('-f', '--follow', is_flag=True, default=False, help="follow logs")
-@foreach('container')
-def log(cont, follow):
+@click.option('-f', '--follow', is_flag=True, default=False, help="follow logs of all containers at once")
+@click.option('-t', '--timestamps', is_flag=True, default=False, help="show timestamps (in follow mode)")
+@click.option('-n', '--tail', default='all', callback=validate_tail, help="number of lines from the end of log")
+@click.option('-s', '--since', callback=validate_since, help="unix timestamp or duration ago (10m, 2h, 1d)")
+def log(containers, follow, timestamps, tail, since):
     """View Docker log for container(s)."""
+    if follow:
+        follow_logs(list(containers), timestamps, tail, since)
+    else:
+        view_log(containers, tail, since)
+
+
+@foreach('container')
+def view_log(cont, tail, since):
     cont.check()
-    for line in cont.logs(follow=follow):
+    for line in cont.logs(follow=False, tail=tail, since=since):
         click.echo(line)
 
 
+def follow_logs(containers, timestamps, tail, since):
+    # Bounded queue makes readers stop reading from docker while output is blocked
+    lines = queue.Queue(maxsize=utils.settings.get('log.buffer', 1000))
+
+    def reader(cont):
+        with utils.addcontext(logger=logging.getLogger('dominator.container'), container=cont):
+            for line in cont.follow(timestamps, tail, since):
+                lines.put((cont, line))
+
+    for cont in containers:
+        threading.Thread(target=reader, args=(cont,), daemon=True).start()
+
+    try:
+        while True:
+            cont, line = lines.get()
+            if len(containers) > 1:
+                line = '{}:{} {}'.format(cont.ship.name, cont.name, line)
+            click.echo(line)
+    except KeyboardInterrupt:
+        pass
+
+
+@readonly
+@container.command()
+@click.pass_obj
+@click.option('-o', '--output', type=click.Path(file_okay=False),
+              help="directory to store archives in (archivedir setting by default)")
+@click.option('-k', '--keep', default=30, help="number of daily archive files kept per container (0 to keep all)")
+def archive(containers, output, keep):
+    """Append new log lines to local gzipped archives."""
+    containers = list(containers)
+    if not containers:
+        return
+    shipment = containers[0].ship.shipment
+    default = os.path.join(utils.settings.dirpath, 'archive')
+    output = os.path.expanduser(output or utils.settings.get('archivedir', default))
+    cursors = utils.StateCache(os.path.join(output, shipment.name, 'cursors.json'))
+    shipment.check(containers)
+
+    def archive_container(cont):
+        with utils.addcontext(logger=logging.getLogger('dominator.container'), container=cont):
+            state = cursors.get(cont.fullname, maxage=float('inf'))
+            cursor = [state['last'], state.get('seen', 0)] if state else ['', 0]
+            if cont.id is None:
+                return cursor, 0
+            lines = ((timestamp + 'Z', line) for timestamp, line in cont.timedlogs(cursor=cursor))
+            try:
+                count = utils.archive_lines(os.path.join(output, shipment.name, cont.ship.name, cont.name),
+                                            lines, keep)
+            except Exception:
+                getlogger().exception('failed to archive container log')
+                count = None
+            return cursor, count
+
+    for cont, (cursor, count) in zip(containers, utils.parallel(archive_container, containers)):
+        if cursor[0]:
+            cursors.set(cont.fullname, last=cursor[0], seen=cursor[1])
+        click.echo('{:60.60} {}'.format(cont.fullname, 'failed' if count is None else '{} lines'.format(count)))
+    cursors.save()
+
+
 @container.command('dump')
 @click.pass_obj
+@click.option('-o', '--output', type=click.File('w'), help="file to write to ('-' for stdout without pager)")
 @foreach('container')
-def dump_container(container):
+def dump_container(container, output):
     """Dump container info."""
     container.ship = None
     container.shipment = None
@@ -334,17 +877,17 @@ def dump_container(container):
             for file in volume.files.values():
                 if hasattr(file, 'context'):
                     file.context = 'skipped'
-    click.echo_via_pager(yaml.dump(container))
+    echo_yaml(container, output, explicit_start=True)
 
 
-@cli.group(chain=True)
+@cli.group(chain=True, cls=ObjectGroup)
 @click.pass_context
 @click.option('-p', '--pattern', default='*', help="pattern to filter ship:task")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 def task(ctx, pattern, regex):
     """Container management commands."""
-    shipment = ctx.obj
-    ctx.obj = filterbyname(shipment.tasks, pattern, regex)
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('tasks').filter(pattern, regex)
 
 
 @task.command('exec')
@@ -359,6 +902,7 @@ def task_exec(tasks, keep, command):
     common_exec(task, keep)
 
 
+@readonly
 @task.command('list')
 @click.pass_obj
 @foreach('task')
@@ -367,16 +911,17 @@ def task_list(task):
     click.echo(task.fullname)
 
 
-@cli.group()
+@cli.group(cls=ObjectGroup)
 @click.option('-p', '--pattern', default='*', help="pattern to filter files (ship:container:volume:file)")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 @click.pass_context
 def file(ctx, pattern, regex):
     """File management commands."""
-    shipment = ctx.obj
-    ctx.obj = list(filterbyname(shipment.files, pattern, regex))
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('files').filter(pattern, regex)
 
 
+@readonly
 @file.command('list')
 @click.pass_obj
 @foreach('file')
@@ -385,6 +930,7 @@ def list_files(file):
     click.echo('{file.fullname:60.60} {file.fullpath}'.format(file=file))
 
 
+@readonly
 @file.command('view')
 @click.pass_obj
 @foreach('file')
@@ -393,13 +939,48 @@ def view_files(file):
     file.volume.container.ship.spawn('less -S {}'.format(file.fullpath))
 
 
+@readonly
+@file.command('tail')
+@click.pass_obj
+@click.option('-f', '--follow', is_flag=True, default=False, help="keep reading new lines")
+@click.option('-i', '--interval', default=5.0, help="seconds between reads in follow mode")
+@click.option('-c', '--bytes', 'tail', default=64 * 1024, help="bytes to show from the end of files read first time")
+def tail_files(files, follow, interval, tail):
+    """Show new lines of log files merged in time order."""
+    files = [file for file in files if isinstance(file, LogFile)]
+    if not files:
+        return
+    shipment = files[0].volume.container.ship.shipment
+    cache = utils.StateCache(utils.getcachepath('logfiles', shipment.name + '.json'))
+    cursors = {}
+    for file in files:
+        entry = cache.get(file.fullname, maxage=float('inf'))
+        if entry is not None:
+            cursors[file.fullname] = entry['inode'], entry['offset']
+
+    try:
+        while True:
+            with utils.addcontext(logger=logging.getLogger('dominator.file')):
+                lines = collectlogs(files, cursors, tail=tail)
+            for file, _, line in lines:
+                click.echo('{} {}'.format(file.fullname, line))
+            for name, (inode, offset) in cursors.items():
+                cache.set(name, inode=inode, offset=offset)
+            cache.save()
+            if not follow:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
 @cli.group(chain=True)
 @click.pass_context
 @click.option('-p', '--pattern', default='*', help="pattern to filter images")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 def image(ctx, pattern, regex):
     """Image management commands."""
-    shipment = ctx.obj
+    shipment = getshipment(ctx.obj)
     images = []
     if not regex:
         pattern = fnmatch.translate(pattern)
@@ -436,16 +1017,17 @@ def list_images(image):
     click.echo(image.repository)
 
 
-@cli.group()
+@cli.group(cls=ObjectGroup)
 @click.pass_context
 @click.option('-p', '--pattern', 'pattern', default='*', help="pattern to filter ships")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 def ship(ctx, pattern, regex):
     """Ship management commands."""
-    shipment = ctx.obj
-    ctx.obj = filterbyname(shipment.ships.values(), pattern, regex)
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('ships').filter(pattern, regex)
 
 
+@readonly
 @ship.command('list')
 @click.pass_obj
 @foreach('ship')
@@ -462,6 +1044,37 @@ def restart_ship(ship):
     ship.restart()
 
 
+@ship.command('gc')
+@click.pass_obj
+@click.option('-k', '--keep', default=1, help="number of previous image generations to keep")
+@click.option('-n', '--dry-run', is_flag=True, default=False, help="only report what could be removed")
+def gc_ships(ships, keep, dry_run):
+    """Remove dead containers and stale images from ship(s)."""
+    def collect(ship):
+        with utils.addcontext(logger=logging.getLogger('dominator.ship'), ship=ship):
+            try:
+                containers, images = ship.getgarbage(keep)
+                reclaimable = sum(cinfo.get('SizeRw', 0) for cinfo in containers) + \
+                    sum(iinfo.get('Size', 0) for iinfo in images)
+                if not dry_run:
+                    reclaimable = ship.removegarbage(containers, images)
+            except Exception:
+                getlogger().exception('failed to collect garbage')
+                return None
+            return len(containers), len(images), reclaimable
+
+    total = 0
+    for ship, result in zip(ships, utils.parallel(collect, ships)):
+        if result is None:
+            click.echo('{:15.15} failed'.format(ship.name))
+            continue
+        containers, images, reclaimable = result
+        total += reclaimable
+        click.echo('{:15.15} {:5} containers {:5} images {:>10}'.format(
+            ship.name, containers, images, utils.humansize(reclaimable)))
+    click.echo('{} {}'.format('reclaimable' if dry_run else 'reclaimed', utils.humansize(total)))
+
+
 @ship.group('container')
 @click.pass_context
 @click.option('-p', '--pattern', default='*', help="filter containers using pattern")
@@ -504,25 +1117,28 @@ def inspect_ship_containers(cinfos):
 @ship_container.command('log')
 @click.pass_obj
 @click.option('-f', '--follow', is_flag=True, default=False, help="follow logs")
-def view_ship_container_log(cinfos, follow):
+@click.option('-n', '--tail', default='all', callback=validate_tail, help="number of lines from the end of log")
+@click.option('-s', '--since', callback=validate_since, help="unix timestamp or duration ago (10m, 2h, 1d)")
+def view_ship_container_log(cinfos, follow, tail, since):
     """Outputs container logs for arbitary container on a ship."""
     for cinfo in cinfos:
         cont = Container(cinfo['Names'][0][1:], cinfo['ship'], None)
         cont.check(cinfo)
-        for line in cont.logs(follow):
+        for line in cont.logs(follow, tail, since):
             click.echo(line)
 
 
-@cli.group()
+@cli.group(cls=ObjectGroup)
 @click.option('-p', '--pattern', 'pattern', default='*', help="pattern to filter volumes (ship:container:volume)")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 @click.pass_context
 def volume(ctx, pattern, regex):
     """Commands to manage volumes."""
-    shipment = ctx.obj
-    ctx.obj = list(filterbyname(shipment.volumes, pattern, regex))
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('volumes').filter(pattern, regex)
 
 
+@readonly
 @volume.command('list')
 @click.pass_obj
 @foreach('volume')
@@ -531,16 +1147,17 @@ def list_volumes(volume):
     click.echo('{volume.fullname:30.30} {volume.dest:30.30} {volume.fullpath}'.format(volume=volume))
 
 
-@cli.group()
+@cli.group(cls=ObjectGroup)
 @click.pass_context
 @click.option('-p', '--pattern', 'pattern', default='*', help="pattern to filter ships")
 @click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
 def door(ctx, pattern, regex):
     """Commands to view doors."""
-    shipment = ctx.obj
-    ctx.obj = list(filterbyname(shipment.containers, pattern, regex))
+    shipment = getshipment(ctx.obj, pattern, regex, readonly=ctx.command.isreadonly(ctx))
+    ctx.obj = shipment.getindex('containers').filter(pattern, regex)
 
 
+@readonly
 @door.command('list')
 @click.pass_obj
 def list_doors(containers):
@@ -551,6 +1168,57 @@ def list_doors(containers):
                 click.echo('{:30.30} {:20.20} {}'.format(container.fullname, name, url))
 
 
+@cli.command()
+@click.pass_obj
+@click.option('-p', '--pattern', default='*', help="pattern to filter ship:container")
+@click.option('-r', '--regex', is_flag=True, default=False, help="use regex instead of wildcard")
+def watch(shipment, pattern, regex):
+    """Show live containers status using Docker events."""
+    shipment = getshipment(shipment, pattern, regex, readonly=True)
+    containers = shipment.getindex('containers').filter(pattern, regex)
+    ships = {cont.ship.name: cont.ship for cont in containers}
+    watched = set(containers)
+    changed = {}
+    events = queue.Queue()
+
+    def listen(ship, since):
+        with utils.addcontext(logger=logging.getLogger('dominator.ship'), ship=ship):
+            for event in ship.events(since):
+                if event.get('status') in EVENT_STATUSES:
+                    events.put((ship, event))
+
+    def draw():
+        click.clear()
+        for cont in containers:
+            color = Fore.GREEN if cont.running else Fore.RED
+            click.echo('{c.fullname:60.60} {color}{id:10.7} {c.status:30.30}{reset} {changed}'.format(
+                c=cont, color=color, id=cont.id or '', reset=Fore.RESET, changed=changed.get(cont, '')))
+
+    # subscribe to events starting from the moment before listing to not miss anything
+    since = int(time.time())
+    shipment.check(containers)
+    for ship in ships.values():
+        threading.Thread(target=listen, args=(ship, since), daemon=True).start()
+
+    try:
+        draw()
+        while True:
+            batch = [events.get()]
+            # process all pending events before redrawing
+            while not events.empty():
+                batch.append(events.get())
+            updated = False
+            for ship, event in batch:
+                cont = ship.getcontainer(event)
+                if cont in watched and cont.handle_event(event):
+                    changed[cont] = datetime.datetime.fromtimestamp(event['time']).strftime('%H:%M:%S')
+                    updated = True
+            if updated:
+                draw()
+    except KeyboardInterrupt:
+        pass
+
+
 @cli.group('config')
 def config():
     """Commands to manage local config files."""
@@ -566,6 +1234,7 @@ def dump_config():
 @config.command('create')
 def create_config():
     """(Re)create config files with default values."""
+    import pkg_resources
     for filename in ['settings.yaml', 'logging.yaml']:
         src = pkg_resources.resource_stream('dominator.utils', filename)
         dstpath = os.path.join(utils.settings.dirpath, filename)
@@ -577,17 +1246,5 @@ def create_config():
             dst.write(src.read())
 
 
-@utils.makesorted(lambda o: o.fullname)
-def filterbyname(objects, pattern, regex):
-    if not regex:
-        pattern = fnmatch.translate(pattern)
-    for obj in objects:
-        if re.match(pattern, obj.fullname):
-            yield obj
-
-
 def getversion():
-    try:
-        return pkg_resources.get_distribution('dominator').version
-    except pkg_resources.DistributionNotFound:
-        return '(local)'
+    return utils.__version__
@@ -18,16 +18,17 @@ import shutil
 import datetime
 import socket
 import copy
+import copyreg
 import itertools
 import logging
+import time
+import calendar
+import collections
+import heapq
+import shlex
 
 import yaml
-import pkg_resources
-import docker
-import docker.errors
-import mako.template
 import subprocess
-import difflib
 
 from .. import utils
 
@@ -50,6 +51,132 @@ class BaseShip:
     def fullname(self):
         return self.name
 
+    @utils.aslist
+    def getimages(self):
+        """Returns all images (including parents) referenced by ship's containers and tasks"""
+        for container in itertools.chain(self.containers.values(), self.shipment.tasks):
+            if container.ship.name != self.name:
+                continue
+            image = container.image
+            while image is not None:
+                yield image
+                image = getattr(image, 'parent', None)
+
+    def getgarbage(self, keep=0):
+        """Finds dead containers and stale images which are not referenced by the shipment.
+        Only containers named after the shipment and images from shipment's repositories
+        are considered. `keep` newest unreferenced images of each repository are preserved.
+        Returns pair of lists with docker info dicts (containers, images).
+        """
+        self.logger.debug('looking for garbage')
+        prefix = '/{}.'.format(self.shipment.name)
+        names = {'/' + container.dockername for container in self.containers.values()}
+        names.update('/' + task.dockername for task in self.shipment.tasks if task.ship.name == self.name)
+        cinfos = self.docker.containers(all=True, size=True)
+        containers = [cinfo for cinfo in cinfos
+                      if cinfo['Names'] and cinfo['Names'][0].startswith(prefix)
+                      and cinfo['Names'][0] not in names and getstate(cinfo) in GARBAGE_STATES]
+
+        images = self.getimages()
+        repositories = {image.getfullrepository() for image in images}
+        ids = {image.id for image in images if image.id is not None}
+        tags = {'{}:{}'.format(image.getfullrepository(), image.tag) for image in images}
+        # Images of all remaining containers are in use too (dominator refers them as repo:id)
+        garbageids = {cinfo['Id'] for cinfo in containers}
+        for cinfo in cinfos:
+            if cinfo['Id'] not in garbageids:
+                tags.add(cinfo['Image'])
+                ids.add(cinfo['Image'].rsplit(':', 1)[-1])
+
+        stale = {}
+        for iinfo in self.docker.images():
+            repotags = iinfo.get('RepoTags') or []
+            if iinfo['Id'] in ids or any(repotag in tags for repotag in repotags):
+                continue
+            for repotag in repotags:
+                repository = repotag.rsplit(':', 1)[0]
+                if repository in repositories:
+                    stale.setdefault(repository, []).append(iinfo)
+                    break
+
+        images = []
+        for repository, iinfos in sorted(stale.items()):
+            iinfos.sort(key=lambda iinfo: iinfo.get('Created', 0), reverse=True)
+            images.extend(iinfos[keep:])
+        return containers, images
+
+    def events(self, since=None):
+        """Yields docker events forever, reconnecting on errors. After reconnect events are
+        resumed from the last received event timestamp, so nothing is missed.
+        """
+        seen = set()
+        while True:
+            try:
+                self.logger.debug('listening for docker events', since=since)
+                for event in self.docker.events(since=since, decode=True):
+                    key = (event.get('id'), event.get('status'), event.get('timeNano'))
+                    if event['time'] == since:
+                        if key in seen:
+                            # already received before reconnect
+                            continue
+                    else:
+                        since = event['time']
+                        seen.clear()
+                    seen.add(key)
+                    yield event
+            except Exception as e:
+                self.logger.warning('docker events stream broken, reconnecting', error=e)
+                time.sleep(1)
+
+    def getcontainer(self, event):
+        """Returns ship's container the docker event is about (or None)"""
+        import docker.errors
+        if event.get('Type', 'container') != 'container':
+            return None
+        for container in self.containers.values():
+            if container.id == event['id']:
+                return container
+        name = event.get('Actor', {}).get('Attributes', {}).get('name')
+        if name is None:
+            if event.get('status') == 'destroy':
+                return None
+            try:
+                name = self.docker.inspect_container(event['id'])['Name'][1:]
+            except docker.errors.APIError:
+                return None
+        for container in self.containers.values():
+            if container.dockername == name:
+                return container
+
+    def removegarbage(self, containers, images):
+        """Removes containers and images found by `getgarbage`. Returns number of reclaimed bytes."""
+        import docker.errors
+        reclaimed = 0
+        for cinfo in containers:
+            self.logger.info('removing dead container', id=cinfo['Id'], names=cinfo['Names'])
+            try:
+                self.docker.remove_container(cinfo['Id'], v=True)
+            except docker.errors.APIError as e:
+                if e.response.status_code == 404:
+                    self.logger.debug('container is already removed', id=cinfo['Id'])
+                elif e.response.status_code == 409:
+                    self.logger.warning('container can not be removed, skipping', id=cinfo['Id'], error=e.explanation)
+                else:
+                    raise
+            else:
+                reclaimed += cinfo.get('SizeRw', 0)
+        for iinfo in images:
+            self.logger.info('removing stale image', id=iinfo['Id'], tags=iinfo.get('RepoTags'))
+            try:
+                self.docker.remove_image(iinfo['Id'])
+            except docker.errors.APIError as e:
+                if e.response.status_code != 409:
+                    raise
+                self.logger.warning('image is in use, skipping', id=iinfo['Id'])
+            else:
+                reclaimed += iinfo.get('Size', 0)
+        return reclaimed
+
 
 class Ship(BaseShip):
     """
@@ -74,6 +201,7 @@ class Ship(BaseShip):
     @property
     @utils.cached
     def docker(self):
+        import docker
         self.logger.debug('connecting to docker api on ship', fqdn=self.fqdn)
         return docker.Client('http://{}:{}'.format(self.fqdn, self.port))
 
@@ -102,6 +230,36 @@ class Ship(BaseShip):
         tar = ssh.run('tar -cC {} .'.format(remotepath)).stdout
         subprocess.check_output('tar -x -C {}'.format(localpath), input=tar, shell=True)
 
+    def move(self, srcpath, dstpath):
+        """Replace directory on ship with another one using ssh
+        """
+        self.logger.debug("moving from %s to %s", srcpath, dstpath)
+        ssh = self.getssh()
+        ret = ssh.run('rm -rf {1} && mv {0} {1}'.format(srcpath, dstpath))
+        if ret.returncode != 0:
+            raise RuntimeError(ret.stderr)
+
+    def tailfiles(self, requests):
+        """Reads files on ship using single ssh command, see `utils.tailfile` for
+        `requests` items and result format.
+        """
+        self.logger.debug('tailing files', count=len(requests))
+        script = TAILFILE_SCRIPT + ''.join(
+            't {} {} {} {} {}\n'.format(shlex.quote(path), shlex.quote(inode), offset, int(restart), limit)
+            for path, inode, offset, restart, limit in requests)
+        ret = self.getssh().run(script)
+        if ret.returncode != 0:
+            raise RuntimeError(ret.stderr)
+        results = []
+        pos = 0
+        for _ in requests:
+            eol = ret.stdout.index(b'\n', pos)
+            inode, size, start, count = ret.stdout[pos:eol].decode().split()
+            size, start = int(size), int(start)
+            pos = eol + 1 + int(count)
+            results.append((inode, size, start, ret.stdout[eol+1:pos]))
+        return results
+
     def spawn(self, command):
         ssh = self.getssh()
         sshcommand = ssh.ssh_command(command, forward_ssh_agent=False)
@@ -115,20 +273,33 @@ class Ship(BaseShip):
         ssh.run('restart docker')
 
 
+def generate_certificate():
+    """Generates self-signed certificate and returns it along with its private key in PEM format"""
+    from OpenSSL import crypto
+    k = crypto.PKey()
+    k.generate_key(crypto.TYPE_RSA, 1024)
+    cert = crypto.X509()
+    cert.set_serial_number(1000)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(315360000)
+    cert.set_pubkey(k)
+    cert.sign(k, 'sha1')
+    certpem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode()
+    keypem = crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode()
+    return certpem + keypem
+
+
 class LocalShip(BaseShip):
-    def __init__(self):
-        from OpenSSL import crypto
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 1024)
-        cert = crypto.X509()
-        cert.set_serial_number(1000)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(315360000)
-        cert.set_pubkey(k)
-        cert.sign(k, 'sha1')
-        certpem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode()
-        keypem = crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode()
-        self.certificate = certpem + keypem
+    @property
+    @utils.cached
+    def certificate(self):
+        """Certificate with private key for local development, it is generated once and kept in cache directory"""
+        path = utils.getcachepath('localship', 'certificate')
+        certificate = utils.loadcache(path, 'certificate')
+        if certificate is None:
+            certificate = generate_certificate()
+            utils.savecache(path, 'certificate', certificate)
+        return certificate
 
     @property
     def datacenter(self):
@@ -155,6 +326,7 @@ class LocalShip(BaseShip):
     @property
     @utils.cached
     def docker(self):
+        import docker
         return docker.Client(utils.settings.get('docker.url'))
 
     @property
@@ -177,11 +349,52 @@ class LocalShip(BaseShip):
         shutil.rmtree(localpath, ignore_errors=True)
         shutil.copytree(remotepath, localpath)
 
+    def move(self, srcpath, dstpath):
+        """Replace directory on localship with another one using shutil
+        """
+        shutil.rmtree(dstpath, ignore_errors=True)
+        shutil.move(srcpath, dstpath)
+
+    def tailfiles(self, requests):
+        return [utils.tailfile(*request) for request in requests]
+
     def spawn(self, command):
         i = utils.PtyInterceptor()
         i.spawn(['bash', '-c', command])
 
 
+# Shell implementation of `utils.tailfile` used by `Ship.tailfiles`, prints "inode size start count"
+# line followed by exactly count bytes of file (padded with zeros if file is truncated meanwhile)
+TAILFILE_SCRIPT = """
+t() {
+    s=$(stat -L -c '%i %s' "$1" 2>/dev/null) || s='- 0'
+    set -- "$@" $s
+    start=$3
+    if [ -z "$2" ]; then
+        start=$(($7 > $3 ? $7 - $3 : 0))
+    elif [ "$6" != "$2" ] || [ "$7" -lt "$3" ]; then
+        if [ "$4" = 1 ]; then start=0; else start=$7; fi
+    fi
+    n=$(($7 - start < $5 ? $7 - start : $5))
+    echo "$6 $7 $start $n"
+    { tail -c +$((start + 1)) "$1" 2>/dev/null | head -c $n; head -c $n /dev/zero; } | head -c $n
+}
+"""
+
+FINGERPRINT_LABEL = 'dominator.fingerprint'
+# States of containers which are not going to run by themselves and could be removed as garbage
+GARBAGE_STATES = ('exited', 'created', 'dead')
+# Container statuses (in terms of container listing) set by docker events
+EVENT_STATUSES = {
+    'create': 'Created',
+    'start': 'Up',
+    'restart': 'Up',
+    'unpause': 'Up',
+    'pause': 'Up (Paused)',
+    'die': 'Exited',
+    'stop': 'Exited',
+    'destroy': 'not found',
+}
 DEFAULT_NAMESPACE = object()
 DEFAULT_REGISTRY = object()
 
@@ -222,6 +435,7 @@ class Image:
         return self.id
 
     def _streamoperation(self, func, **kwargs):
+        import docker.errors
         with utils.addcontext(image=self, docker=func.__self__, operation=func.__name__):
             logger = logging.getLogger('dominator.docker.'+func.__name__)
             for line in func(stream=True, **kwargs):
@@ -248,6 +462,7 @@ class Image:
         self._streamoperation(dock.pull, repository=self.getfullrepository(), tag=tag,
                               insecure_registry=utils.settings.get('docker.registry.insecure', False))
         Image.gettags.cache_clear()
+        Image.inspect.cache_clear()
         self.getid()
 
     def build(self, dock=None, **kwargs):
@@ -255,6 +470,7 @@ class Image:
         dock = dock or utils.getdocker()
         self._streamoperation(dock.build, tag='{}:{}'.format(self.getfullrepository(), self.tag), **kwargs)
         Image.gettags.cache_clear()
+        Image.inspect.cache_clear()
         self.id = None
         self.getid()
 
@@ -268,6 +484,7 @@ class Image:
             for tag in image['RepoTags']:
                 yield tag.split(':')[-1], image['Id']
 
+    @utils.cached
     def inspect(self):
         result = utils.getdocker().inspect_image(self.getid())
         # Workaround: Docker sometimes returns "config" key in different casing
@@ -378,7 +595,128 @@ class SourceImage(Image):
         return self.ports
 
 
-class Container:
+@functools.lru_cache()
+def getslotnames(cls):
+    """Returns names of all slots declared by class and its bases, except private (underscored) ones,
+    which keep caches and are not part of object state
+    """
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = vars(base).get('__slots__', ())
+        names.extend([slots] if isinstance(slots, str) else slots)
+    return [name for name in names if name not in ('extra', '__dict__', '__weakref__') and not name.startswith('_')]
+
+
+class Compact:
+    """Base class for entities which are numerous in large shipments (containers, doors, volumes, files).
+    Their attributes are kept in `__slots__` instead of per-object dict, so every subclass should declare
+    its own `__slots__` (backrefs included). Other attributes (e.g. set by obedients) are kept in `extra`
+    dict, which is created on demand, or obedients could declare their own subclasses with `__slots__`.
+    State of object is a dict of all its attributes, so YAML representation is the same as for ordinary
+    objects (see `represent_compact`).
+    """
+    __slots__ = ('extra',)
+
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+        object.__setattr__(obj, 'extra', None)
+        return obj
+
+    def __getattr__(self, name):
+        # called only if attribute is not found in slots or class, so it is on hot path of `getattr(obj, name, None)`
+        extra = object.__getattribute__(self, 'extra')
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:
+            if hasattr(type(self), name):
+                raise
+            extra = object.__getattribute__(self, 'extra')
+            if extra is None:
+                extra = {}
+                object.__setattr__(self, 'extra', extra)
+            extra[name] = value
+
+    def __delattr__(self, name):
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            extra = object.__getattribute__(self, 'extra')
+            if extra is None or name not in extra:
+                raise AttributeError(name) from None
+            del extra[name]
+
+    def __getstate__(self):
+        state = {}
+        for name in getslotnames(type(self)):
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        extra = object.__getattribute__(self, 'extra')
+        if extra:
+            state.update(extra)
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __reduce_ex__(self, protocol):
+        # State is passed as slot state (second item of pair), which pickle and copy set with `setattr`
+        # after object is created, so recursive objects (backrefs) are restored without `__setstate__`
+        return copyreg.__newobj__, (type(self),), (None, self.__getstate__())
+
+    def __copy__(self):
+        # make_backrefs copies every shared object, so attributes are copied directly without state dict
+        cls = type(self)
+        obj = cls.__new__(cls)
+        for name in getslotnames(cls):
+            try:
+                object.__setattr__(obj, name, object.__getattribute__(self, name))
+            except AttributeError:
+                pass
+        extra = object.__getattribute__(self, 'extra')
+        if extra:
+            object.__setattr__(obj, 'extra', dict(extra))
+        if hasattr(self, '__dict__'):
+            obj.__dict__.update(self.__dict__)
+        return obj
+
+
+def represent_compact(dumper, obj):
+    # The same mapping as PyYAML makes for ordinary objects. Without `__setstate__` PyYAML
+    # sets attributes with `setattr` and can construct recursive objects (backrefs).
+    cls = type(obj)
+    return dumper.represent_mapping('tag:yaml.org,2002:python/object:{}.{}'.format(cls.__module__, cls.__name__),
+                                    obj.__getstate__())
+yaml.add_multi_representer(Compact, represent_compact)
+
+
+def getstate(cinfo):
+    """Returns container state (like 'running', 'paused', 'restarting' or 'exited') from docker listing info.
+    Listings have `State` since API 1.23, for older ones it is parsed from `Status`.
+    """
+    state = cinfo.get('State')
+    if isinstance(state, str):
+        return state
+    status = cinfo['Status'].lower()
+    if status.startswith('up'):
+        return 'paused' if '(paused)' in status else 'running'
+    # status of container which was never started is empty in old docker versions
+    return status.split(' ', 1)[0] or 'created'
+
+
+def logtime(timestamp):
+    """Converts docker log timestamp to unix time in seconds"""
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+class Container(Compact):
+    __slots__ = ('name', 'ship', 'image', 'command', 'volumes', 'memory', 'env', 'id', 'status', 'hostname',
+                 'network_mode', 'user', 'privileged', 'doors', 'actualfingerprint')
+
     def __init__(self, name: str, image: Image, ship: Ship=None, command: str=None, hostname: str=None,
                  memory: int=0, volumes: dict=None, env: dict=None, doors: dict=None,
                  network_mode: str='', user: str='', privileged: bool=False):
@@ -401,10 +739,11 @@ class Container:
         return 'Container({c.fullname}[{c.id!s:7.7}])'.format(c=self)
 
     def __getstate__(self):
-        state = vars(self)
-        # id and status are temporary fields and should not be saved
+        state = Compact.__getstate__(self)
+        # id, status and actualfingerprint are temporary fields and should not be saved
         state['id'] = None
         state['status'] = None
+        state.pop('actualfingerprint', None)
         return state
 
     @property
@@ -428,7 +767,7 @@ class Container:
 
     def check(self, cinfo=None):
         """This function tries to find container on the associated ship
-        by listing all containers. If found, it fills `id` and `status` attrs.
+        by listing all containers. If found, it fills `id`, `status` and `actualfingerprint` attrs.
         If `cinfo` is provided, then skips docker api call for container listing.
         """
         if cinfo is None:
@@ -441,12 +780,72 @@ class Container:
         if cinfo:
             self.id = cinfo.get('Id', self.id)
             self.status = cinfo.get('Status', self.status)
+            if 'Labels' in cinfo:
+                self.actualfingerprint = (cinfo['Labels'] or {}).get(FINGERPRINT_LABEL)
         else:
             self.id = None
             self.status = 'not found'
+            self.actualfingerprint = None
+
+    def handle_event(self, event):
+        """Updates `id` and `status` according to docker event. Returns True if event changes status."""
+        status = EVENT_STATUSES.get(event.get('status'))
+        if status is None:
+            return False
+        if status == 'not found':
+            self.check({})
+        else:
+            self.check({'Id': event['id'], 'Status': status})
+        return True
+
+    def getfingerprint(self):
+        """Calculates digest of requested container state. It is attached to container
+        as a label on creation to detect config drift without inspecting container
+        and downloading config files.
+        """
+        def filedigest(file):
+            return file.digest if hasattr(type(file), 'data') else None
+
+        dump = json.dumps({
+            'image': self.image.getid(),
+            'repository': self.image.getfullrepository(),
+            'command': self.command,
+            'hostname': self.hostname,
+            'memory': self.memory,
+            'env': self.env,
+            'network_mode': self.network_mode,
+            'user': self.user,
+            'privileged': self.privileged,
+            'doors': {name: [door.portspec, door.externalport, door.exposed] for name, door in self.doors.items()},
+            'volumes': {volume.dest: {
+                'type': type(volume).__name__,
+                'path': volume.fullpath,
+                'ro': volume.ro,
+                'files': {name: filedigest(file) for name, file in getattr(volume, 'files', {}).items()},
+            } for volume in self.volumes.values()},
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(dump.encode()).hexdigest()
+
+    def isuptodate(self):
+        """Returns True if container was created with the same fingerprint as requested.
+        False doesn't mean that config differs (container could be created without fingerprint),
+        so full comparison is needed to find out.
+        """
+        return getattr(self, 'actualfingerprint', None) == self.getfingerprint()
+
+    def getdiff(self, full=False):
+        """Returns diff between requested and running container config. Unless `full` is set,
+        containers with matching fingerprint are considered unchanged without comparison.
+        Mismatching fingerprint is only a hint (e.g. it is stale after rerender), so such containers
+        are compared as well.
+        """
+        if not full and self.isuptodate():
+            return []
+        return utils.compare_container(self, self.inspect())
 
     @contextlib.contextmanager
     def execute(self):
+        import docker.errors
         self.logger.debug('executing')
         try:
             try:
@@ -469,23 +868,72 @@ class Container:
             except:
                 self.logger.debug('could not stop container, ignoring')
 
-    def logs(self, follow):
-        self.logger.bind(follow=follow).debug('getting logs from container')
+    def logs(self, follow, tail='all', since=None):
+        """Yields container log lines. Log is always streamed, so it is never loaded into memory as a whole.
+        `tail` limits number of lines from the end of log, `since` is unix timestamp of the first line.
+        """
+        self.logger.bind(follow=follow, tail=tail, since=since).debug('getting logs from container')
         try:
-            if follow:
-                lines = utils.docker_lines(self.ship.docker.logs(self.id, stream=True))
-            else:
-                lines = self.ship.docker.logs(self.id).decode().split('\n')
-            yield from lines
+            yield from utils.docker_lines(self.ship.docker.logs(self.id, stream=True, follow=follow,
+                                                                tail=tail, since=since))
         except KeyboardInterrupt:
             self.logger.debug('received keyboard interrupt')
 
+    def timedlogs(self, follow=False, cursor=None, tail='all', since=None):
+        """Yields pairs (timestamp, line) of container log. Timestamps are docker's RFC3339 ones in UTC
+        without trailing 'Z' and trailing zeros trimmed, so they are ordered lexically.
+        `cursor` is a list of the last received timestamp and number of lines received with it (several
+        lines could have the same timestamp), it is updated with every yielded line. If cursor is set,
+        log is requested from its second and lines replayed up to cursor are skipped, otherwise `tail`
+        and `since` are passed to docker as in `logs`.
+        """
+        if cursor is None:
+            cursor = ['', 0]
+        last, skip = cursor
+        replaying = bool(last)
+        if replaying:
+            tail, since = 'all', logtime(last)
+        stream = self.ship.docker.logs(self.id, stream=True, follow=follow, timestamps=True, tail=tail, since=since)
+        for line in utils.docker_lines(stream):
+            timestamp, _, message = line.partition(' ')
+            timestamp = timestamp.rstrip('Z')
+            if replaying:
+                if timestamp < last:
+                    continue
+                if timestamp == last and skip > 0:
+                    skip -= 1
+                    continue
+                replaying = False
+            if timestamp == cursor[0]:
+                cursor[1] += 1
+            else:
+                cursor[:] = [timestamp, 1]
+            yield timestamp, message
+
+    def follow(self, timestamps=False, tail='all', since=None):
+        """Yields container log lines forever. When stream drops (e.g. container is restarted
+        or recreated) it is reopened from the last received line, so nothing is repeated.
+        `tail` and `since` are applied to the first opened stream only, see `logs`.
+        """
+        cursor = ['', 0]
+        while True:
+            try:
+                self.check()
+                if self.id is not None:
+                    self.logger.debug('following container log', cursor=cursor)
+                    for timestamp, message in self.timedlogs(True, cursor, tail, since):
+                        yield '{}Z {}'.format(timestamp, message) if timestamps else message
+            except Exception as e:
+                self.logger.warning('container log stream broken, reconnecting', error=e)
+            time.sleep(1)
+
     def stop(self):
         self.logger.debug('stopping container')
         self.ship.docker.stop(self.id, timeout=2)
         self.check({'Status': 'stopped'})
 
     def remove(self, force=False):
+        import docker.errors
         self.logger.debug('removing container')
         try:
             self.ship.docker.remove_container(self.id, force=force)
@@ -506,8 +954,14 @@ class Container:
         for volume in self.volumes.values():
             volume.render(self)
 
+        self.check(self._pullcreate())
+        self.actualfingerprint = self.getfingerprint()
+        self.logger.debug('container created')
+
+    def _pullcreate(self, name=None):
+        import docker.errors
         try:
-            cinfo = self._create()
+            return self._create(name)
         except docker.errors.APIError as e:
             if e.response.status_code != 404:
                 raise
@@ -522,12 +976,9 @@ class Container:
                 self.logger.info("could not find requested image in registry, pushing repo")
                 self.image.push()
                 self.image.pull(self.ship.docker)
-            cinfo = self._create()
-
-        self.check(cinfo)
-        self.logger.debug('container created')
+            return self._create(name)
 
-    def _create(self):
+    def _create(self, name=None):
         self.logger.debug('creating container', image=self.image)
         return self.ship.docker.create_container(
             image='{}:{}'.format(self.image.getfullrepository(), self.image.getid()),
@@ -535,20 +986,33 @@ class Container:
             command=self.command,
             mem_limit=self.memory,
             environment=self.env,
-            name=self.dockername,
+            labels={FINGERPRINT_LABEL: self.getfingerprint()},
+            name=name or self.dockername,
             ports=[(door.port, door.protocol) for door in self.doors.values()],
             stdin_open=True,
             detach=False,
             user=self.user,
         )
 
-    def run(self):
+    def run(self, fastswap=False):
+        """Ensures that container with requested config is running.
+        Returns downtime in seconds if running container was replaced.
+        If `fastswap` is set, replacement is prepared before stopping running container.
+        """
+        stopped = None
         self.check()
         if self.running:
+            if self.isuptodate():
+                self.logger.info('found running container with the same fingerprint, keeping')
+                return
             self.logger.info('found running container with the same name, comparing config with requested')
             diff = utils.compare_container(self, self.inspect())
             if diff:
+                if fastswap:
+                    self.logger.info('running container config differs from requested, swapping', diff=diff)
+                    return self.swap()
                 self.logger.info('running container config differs from requested, stopping', diff=diff)
+                stopped = time.time()
                 self.stop()
             else:
                 self.logger.info('running container config identical to requested, keeping')
@@ -560,8 +1024,45 @@ class Container:
 
         self.create()
         self.start()
+        if stopped is not None:
+            return time.time() - stopped
+
+    def swap(self):
+        """Replaces running container: pulls image, renders config volumes to staging paths
+        and creates new container under temporary name, then stops and removes old container,
+        moves staged volumes in place, renames and starts new one. Returns downtime in seconds.
+        """
+        import docker.errors
+        self.logger.debug('preparing replacement container')
+        tempname = self.dockername + '.staging'
+        staged = [volume for volume in self.volumes.values() if isinstance(volume, ConfigVolume)]
+        for volume in staged:
+            volume.render(self, volume.fullpath + '.staging')
+
+        try:
+            cinfo = self._pullcreate(tempname)
+        except docker.errors.APIError as e:
+            if e.response.status_code != 409:
+                raise
+            self.logger.info('found stale replacement container, removing')
+            self.ship.docker.remove_container(tempname, force=True)
+            cinfo = self._pullcreate(tempname)
+
+        stopped = time.time()
+        self.stop()
+        self.remove()
+        for volume in staged:
+            self.ship.move(volume.fullpath + '.staging', volume.fullpath)
+        self.ship.docker.rename(cinfo['Id'], self.dockername)
+        self.check(cinfo)
+        self.actualfingerprint = self.getfingerprint()
+        self.start()
+        downtime = time.time() - stopped
+        self.logger.debug('container swapped', downtime=downtime)
+        return downtime
 
     def start(self):
+        import docker.errors
         self.logger.debug('starting container')
 
         def _start():
@@ -598,22 +1099,88 @@ class Container:
     def inspect(self):
         return self.ship.docker.inspect_container(self.id)
 
+    def getaction(self, full=False):
+        """Computes action needed to bring container to requested state using
+        `id` and `status` filled by `check`. Returns pair (action, diff), where action is
+        'create' if container is not found, 'recreate' if it's stopped or its config differs,
+        'rerender' if only config files differ and 'noop' if nothing should be done.
+        Running containers with matching fingerprint are not compared unless `full` is set.
+        """
+        if self.id is None:
+            return 'create', []
+        if not self.running:
+            return 'recreate', []
+        if not full and self.isuptodate():
+            return 'noop', []
+        diff = utils.compare_container(self, self.inspect())
+        if not diff:
+            return 'noop', diff
+        if all(key[0] == 'volumes' and key[2:3] == ('files',) for key, _ in diff):
+            return 'rerender', diff
+        return 'recreate', diff
+
+    def apply(self, action):
+        """Executes action computed by `getaction`."""
+        self.logger.info('applying action', action=action)
+        if action == 'create':
+            self.create()
+            self.start()
+        elif action == 'recreate':
+            if self.running:
+                self.stop()
+            if self.id:
+                self.remove()
+            self.create()
+            self.start()
+        elif action == 'rerender':
+            for volume in self.volumes.values():
+                volume.render(self)
+            self.ship.docker.restart(self.id, timeout=2)
+        elif action != 'noop':
+            raise ValueError('unknown action {}'.format(action))
+
     def wait(self):
         return self.ship.docker.wait(self.id)
 
+    def waitready(self, timeout):
+        """Waits till all exposed tcp doors answer probes.
+        Returns dict with time spent waiting for every door.
+        Raises TimeoutError if some door did not answer in `timeout` seconds.
+        """
+        self.logger.debug('waiting for doors to answer')
+        started = time.time()
+        deadline = started + timeout
+        latencies = {}
+        for name, door in sorted(self.doors.items()):
+            if not door.exposed or door.protocol != 'tcp':
+                continue
+            while True:
+                try:
+                    door.probe(timeout=max(deadline - time.time(), 0.1))
+                except OSError as e:
+                    if time.time() >= deadline:
+                        raise TimeoutError('door {} did not answer in {}s ({})'.format(door.fullname, timeout, e))
+                    time.sleep(0.5)
+                else:
+                    latencies[name] = time.time() - started
+                    break
+        return latencies
+
     def getport(self, name):
         """DEPRECATED"""
         return self.doors[name].externalport
 
 
 class Task(Container):
-    pass
+    __slots__ = ()
 
 
-class Door:
+class Door(Compact):
     """Door class represents an interface to a container - like Docker port, but with additional
     attributes
     """
+    __slots__ = ('name', 'container', 'schema', 'protocol', 'port', 'exposed', 'externalport', 'paths')
+
     def __init__(self, schema, port=None, protocol='tcp', exposed=True, externalport=None, paths=None):
         """
         schema - something like http, ftp, zookeeper, gopher
@@ -645,12 +1212,36 @@ class Door:
     def portspec(self):
         return '{port}/{protocol}'.format(port=self.port, protocol=self.protocol)
 
+    def probe(self, timeout):
+        """Checks that door answers: requests first url for http(s) doors,
+        opens tcp connection for others. Raises OSError if it does not.
+        """
+        import ssl
+        import urllib.request
+        import urllib.error
+        if self.schema in ('http', 'https'):
+            # services often use self-signed certificates, probe only checks that door answers
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=context))
+            try:
+                opener.open(self.urls[0], timeout=timeout).close()
+            except urllib.error.HTTPError as e:
+                # any response except server errors means that service is up
+                if e.code >= 500:
+                    raise
+        else:
+            socket.create_connection((self.container.ship.fqdn, self.externalport), timeout=timeout).close()
+
     @property
     def fullname(self):
         return '{}:{}:{}'.format(self.container.ship.name, self.container.name, self.name)
 
 
-class Volume:
+class Volume(Compact):
+    __slots__ = ('name', 'container', 'dest')
+
     def __repr__(self):
         return '{}(fullname={self.fullname}, dest={self.dest})'.format(type(self).__name__, self=self)
 
@@ -670,12 +1261,14 @@ class DataVolume(Volume):
     path -- mount point on the host
     ro   -- should volume be mounted read-only
     """
+    __slots__ = ('path', 'ro')
+
     def __init__(self, dest: str, path: str=None, ro=False):
         self.dest = dest
         self.path = path
         self.ro = ro
 
-    def render(self, _):
+    def render(self, _, path=None):
         pass
 
     @property
@@ -685,12 +1278,16 @@ class DataVolume(Volume):
 
 
 class LogVolume(DataVolume):
+    __slots__ = ('files',)
+
     def __init__(self, dest: str=None, path: str=None, files=None):
         DataVolume.__init__(self, dest, path)
         self.files = files or {}
 
 
 class ConfigVolume(Volume):
+    __slots__ = ('files',)
+
     def __init__(self, dest: str, files: dict=None):
         self.dest = dest
         self.files = files or {}
@@ -704,30 +1301,100 @@ class ConfigVolume(Volume):
     def ro(self):
         return True
 
-    def render(self, container):
+    def render(self, container, path=None):
         self.logger.debug('rendering')
         with tempfile.TemporaryDirectory() as tempdir:
             for name, file in self.files.items():
                 file.dump(os.path.join(tempdir, name))
-            container.ship.upload(tempdir, self.fullpath)
+            container.ship.upload(tempdir, path or self.fullpath)
 
     @utils.aslist
     def compare_files(self):
         self.logger.debug('comparing files')
         with tempfile.TemporaryDirectory() as tempdir:
             self.container.ship.download(self.fullpath, tempdir)
-            for name, file in self.files.items():
-                try:
-                    actual = file.load(os.path.join(tempdir, name))
-                    expected = file.data
-                    if actual != expected:
-                        diff = difflib.Differ().compare(actual.split('\n'), expected.split('\n'))
-                        yield ('volumes', self.dest, 'files', name), [line for line in diff if line[:2] != '  ']
-                except FileNotFoundError:
-                    yield ('volumes', self.dest, 'files'), (name, '<not found>')
 
+            def compare(item):
+                name, file = item
+                with utils.addcontext(file=file):
+                    return self.compare_file(name, file, os.path.join(tempdir, name))
+
+            for diff in utils.parallel(compare, self.files.items()):
+                yield from diff
+
+    @utils.aslist
+    def compare_file(self, name, file, path):
+        """Compares file contents with downloaded copy. Files with equal digests are not diffed,
+        binary files and files larger than `diff.maxbytes` setting are only summarized
+        and diff is truncated to `diff.maxlines` setting.
+        """
+        try:
+            with open(path, 'rb') as f:
+                actual = f.read()
+        except FileNotFoundError:
+            yield ('volumes', self.dest, 'files'), (name, '<not found>')
+            return
+
+        if hashlib.sha256(actual).hexdigest() == file.digest:
+            return
+
+        expected = file.rendered
+
+        key = ('volumes', self.dest, 'files', name)
+        summary = ['? differs ({} bytes, expected {} bytes)'.format(len(actual), len(expected))]
+        if max(len(actual), len(expected)) > utils.settings.get('diff.maxbytes', 1024*1024) or \
+                b'\0' in actual or b'\0' in expected:
+            yield key, summary
+            return
+        try:
+            actual = actual.decode()
+        except UnicodeDecodeError:
+            yield key, summary
+            return
+        yield key, utils.difftext(actual, expected.decode(), maxlines=utils.settings.get('diff.maxlines', 1000))
+
+
+class BaseFile(Compact):
+    """Base class for config files. Subclasses provide `data` property with file contents,
+    which is rendered once into bytes with digest (see `rendered`, `digest` and `size`).
+    Rendered contents are dropped when content attributes are set, but should be dropped
+    explicitly with `invalidate` if content is changed in place. They depend on container
+    the file belongs to, so they are not saved or copied (private slots are not part of state).
+    """
+    __slots__ = ('name', 'volume', '_rendered')
+
+    # attributes rendered contents depend on
+    CONTENT_ATTRS = ('content', 'template', 'context')
+
+    def __setattr__(self, name, value):
+        if name in self.CONTENT_ATTRS:
+            self.invalidate()
+        Compact.__setattr__(self, name, value)
+
+    def invalidate(self):
+        object.__setattr__(self, '_rendered', None)
+
+    def render(self):
+        """Returns memoized tuple of rendered contents and its digest"""
+        rendered = getattr(self, '_rendered', None)
+        if rendered is None:
+            data = self.data.encode()
+            rendered = self._rendered = (data, hashlib.sha256(data).hexdigest())
+        return rendered
+
+    @property
+    def rendered(self):
+        return self.render()[0]
+
+    @property
+    def digest(self):
+        """sha256 hexdigest of rendered contents"""
+        return self.render()[1]
+
+    @property
+    def size(self):
+        return len(self.render()[0])
 
-class BaseFile:
     def __str__(self):
         return '{}({:40.40})'.format(type(self).__name__, self.fullname)
 
@@ -750,16 +1417,13 @@ class BaseFile:
     def dump(self, path: str):
         self.logger.debug("writing file", path=path)
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w+', encoding='utf8') as f:
-            f.write(self.data)
-
-    def load(self, path: str):
-        self.logger.debug("loading text file contents", path=path)
-        with open(path) as f:
-            return f.read()
+        with open(path, 'wb') as f:
+            f.write(self.rendered)
 
 
 class TextFile(BaseFile):
+    __slots__ = ('content',)
+
     def __init__(self, text: str=None, filename: str=None):
         """
         Constructs TextFile. If text provided, populate
@@ -770,6 +1434,7 @@ class TextFile(BaseFile):
         if text is not None:
             self.content = text
         else:
+            import pkg_resources
             self.content = pkg_resources.resource_string(utils.getcallingmodule(1).__name__, filename).decode()
 
     @property
@@ -778,6 +1443,8 @@ class TextFile(BaseFile):
 
 
 class TemplateFile(BaseFile):
+    __slots__ = ('template', 'context')
+
     def __init__(self, template: str, **context):
         self.template = template
         self.context = context
@@ -787,7 +1454,7 @@ class TemplateFile(BaseFile):
 
     @property
     def data(self):
-        template = mako.template.Template(self.template)
+        template = utils.templates.get(self.template)
         context = {'this': self.volume.container}
         context.update(self.context)
         self.logger.debug('rendering template file', context=context)
@@ -795,6 +1462,8 @@ class TemplateFile(BaseFile):
 
 
 class YamlFile(BaseFile):
+    __slots__ = ('content',)
+
     def __init__(self, data: dict):
         self.content = data
 
@@ -804,6 +1473,8 @@ class YamlFile(BaseFile):
 
 
 class JsonFile(BaseFile):
+    __slots__ = ('content',)
+
     def __init__(self, data: dict):
         self.content = data
 
@@ -816,9 +1487,13 @@ class Shipment:
     def __init__(self, name, containers, tasks=None):
         self.name = name
         self.tasks = tasks or []
-        ships = {container.ship for container in containers}.union({task.ship for task in self.tasks})
-        for ship in ships:
-            ship.containers = {container.name: container for container in containers if container.ship == ship}
+        ships = {}
+        for container in containers:
+            ships.setdefault(container.ship, {})[container.name] = container
+        for task in self.tasks:
+            ships.setdefault(task.ship, {})
+        for ship, shipcontainers in ships.items():
+            ship.containers = shipcontainers
         self.ships = {ship.name: ship for ship in ships}
 
     @property
@@ -841,44 +1516,94 @@ class Shipment:
         for container in self.containers:
             yield from container.doors.values()
 
+    @utils.cached
+    def getindex(self, kind):
+        """Returns index of shipment's objects of given kind (attribute name like 'containers', 'files'
+        or 'ships') with `filter(pattern, regex)` method. Objects other than ships are indexed by ship
+        (see `utils.SegmentIndex`), so filtering by ship computes fullnames of this ship's objects only.
+        Index is built once, so it should be requested after `make_backrefs`.
+        """
+        if kind == 'ships':
+            return utils.NameIndex(self.ships.values())
+        return utils.SegmentIndex({name: functools.partial(self.getshipobjects, ship, kind)
+                                   for name, ship in self.ships.items()})
+
+    def getshipobjects(self, ship, kind):
+        """Returns shipment's objects of given kind which belong to `ship`"""
+        shipment = copy.copy(self)
+        shipment.ships = {ship.name: ship}
+        shipment.tasks = [task for task in self.tasks if task.ship is ship]
+        return getattr(shipment, kind)
+
+    def check(self, containers=None):
+        """Fills `id` and `status` of containers (all by default) using single listing
+        request per ship, ships are requested concurrently.
+        """
+        containers = list(self.containers if containers is None else containers)
+        ships = {container.ship.name: container.ship for container in containers}
+
+        def listcontainers(ship):
+            with utils.addcontext(ship=ship):
+                utils.getlogger().debug('listing containers')
+                return {cinfo['Names'][0][1:]: cinfo for cinfo in ship.docker.containers(all=True) if cinfo['Names']}
+
+        cinfos = dict(zip(ships, utils.parallel(listcontainers, ships.values())))
+        for container in containers:
+            container.check(cinfos[container.ship.name].get(container.dockername, {}))
+
+    def plan(self, containers=None, full=False):
+        """Computes actions for containers (all by default) concurrently. Returns list of
+        triples (container, action, diff), see `Container.getaction`.
+        """
+        containers = list(self.containers if containers is None else containers)
+        self.check(containers)
+
+        def getaction(container):
+            with utils.addcontext(container=container):
+                return container.getaction(full)
+
+        return [(container, action, diff)
+                for container, (action, diff) in zip(containers, utils.parallel(getaction, containers))]
+
     def make_backrefs(self):
-        def make_backrefs(obj, refname, backrefname):
+        """Sets backrefs (`shipment`, `ship`, `container`, `volume`) and missing names of all
+        objects in shipment in single pass over the graph.
+        """
+        def make_backrefs(obj, refname, backrefname, childrefnames=()):
             ref = getattr(obj, refname)
-            for name, child in ref.copy().items():
-                backref = getattr(child,  backrefname, None)
+            for name, child in list(ref.items()):
+                backref = getattr(child, backrefname, None)
                 if backref is obj:
                     continue
                 if backref is not None:
                     # If single child object is shared between parents, then
                     # we should create copy of it to not override backref attr
-                    # in the shared child object
+                    # in the shared child object. Only mappings of children are copied
+                    # (as they are going to be changed), everything else is still shared.
                     ref[name] = child = copy.copy(child)
-                    # Additionally, copy all list/dict/set attributes to ensure
-                    # that they will not be shared between objects.
-                    # We do not use copy.deepcopy here because it's too slow
-                    # for even medium-sized (hundreds of objects) graphs if there are
-                    # cyclic references (as in this case).
-                    for attrname in vars(child):
-                        attr = getattr(child, attrname)
-                        if isinstance(attr, (list, dict, set)):
-                            setattr(child, attrname, copy.copy(attr))
+                    for attrname in childrefnames:
+                        children = getattr(child, attrname, None)
+                        if isinstance(children, dict):
+                            setattr(child, attrname, dict(children))
                 setattr(child, backrefname, obj)
                 if getattr(child, 'name', None) is None:
                     setattr(child, 'name', name)
 
-        make_backrefs(self, 'ships', 'shipment')
-
-        for ship in self.ships.values():
-            make_backrefs(ship, 'containers', 'ship')
-
-        for container in itertools.chain(self.containers, self.tasks):
+        def make_container_backrefs(container):
             make_backrefs(container, 'doors', 'container')
-            make_backrefs(container, 'volumes', 'container')
-
+            make_backrefs(container, 'volumes', 'container', ['files'])
             for volume in container.volumes.values():
                 if hasattr(volume, 'files'):
                     make_backrefs(volume, 'files', 'volume')
 
+        make_backrefs(self, 'ships', 'shipment', ['containers'])
+        for ship in self.ships.values():
+            make_backrefs(ship, 'containers', 'ship', ['doors', 'volumes'])
+            for container in ship.containers.values():
+                make_container_backrefs(container)
+        for task in self.tasks:
+            make_container_backrefs(task)
+
     @property
     def images(self):
         def compare_source_images(x, y):
@@ -904,12 +1629,89 @@ class Shipment:
 
 
 class LogFile(BaseFile):
+    __slots__ = ('format', 'length')
+
     def __init__(self, format='', length=None):
         if length is None:
             length = len(datetime.datetime.strftime(datetime.datetime.now(), format))
         self.length = length
         self.format = format
 
+    def gettime(self, line):
+        """Returns time parsed from line prefix using `format` or None"""
+        if not self.format:
+            return None
+        try:
+            return datetime.datetime.strptime(line[:self.length], self.format)
+        except ValueError:
+            return None
+
+    def tailrequests(self, inode, offset, limit):
+        """Returns `BaseShip.tailfiles` requests to read at most `limit` bytes of file from offset, file
+        is read from the beginning if it was recreated (inode changed) or truncated. Empty inode means
+        the file wasn't read yet, so only its last `offset` bytes are read.
+        """
+        return [(self.fullpath, inode, offset, True, limit)]
+
 
 class RotatedLogFile(LogFile):
-    pass
+    __slots__ = ()
+
+    def tailrequests(self, inode, offset, limit):
+        # Rotated file (logrotate style `<name>.1`) is read first to not lose lines
+        # written after the last read but before rotation
+        requests = LogFile.tailrequests(self, inode, offset, limit)
+        if inode:
+            requests.insert(0, (self.fullpath + '.1', inode, offset, False, limit))
+        return requests
+
+
+def collectlogs(files, cursors, tail=64 * 1024, limit=1024 * 1024):
+    """Reads new lines of log files (using single ssh command per ship, ships are requested concurrently)
+    starting from `cursors` (dict of file fullname to pair (inode, offset)), which are updated in place.
+    Files without cursor are read starting from their last `tail` bytes, at most `limit` bytes
+    of every file are read per call. Incomplete last lines are left for the next call.
+    Returns list of triples (file, time, line) merged in time order using files' `format`,
+    lines without timestamp get time of the preceding line.
+    """
+    ships = collections.OrderedDict()
+    for file in files:
+        ships.setdefault(file.volume.container.ship.name, []).append(file)
+
+    def collect(shipfiles):
+        ship = shipfiles[0].volume.container.ship
+        with utils.addcontext(ship=ship):
+            requests = [file.tailrequests(*cursors.get(file.fullname, ('', tail)), limit=limit)
+                        for file in shipfiles]
+            results = iter(ship.tailfiles(list(itertools.chain.from_iterable(requests))))
+            streams = []
+            for file, filerequests in zip(shipfiles, requests):
+                parts = [next(results) for _ in filerequests]
+                for (path, _, _, _, _), (_, size, start, data) in zip(filerequests, parts[:-1]):
+                    if start + len(data) < size:
+                        ship.logger.warning('skipping rest of rotated file', path=path,
+                                            size=size - start - len(data))
+                inode, _, start, data = parts.pop()
+                # the first read may start in the middle of line, which is skipped
+                begin = data.find(b'\n') + 1 if not filerequests[-1][1] and start else 0
+                end = data.rfind(b'\n') + 1
+                if not end and len(data) == limit:
+                    # line doesn't fit into limit, so it is split to not get stuck
+                    end = len(data)
+                cursors[file.fullname] = (inode, start + end)
+                # rotated parts are complete, so they are joined with trailing newline
+                text = b''.join(part[3].rstrip(b'\n') + b'\n' for part in parts if part[3]) + data[begin:end]
+                stream = []
+                linetime = datetime.datetime.min
+                for line in text.decode(errors='replace').splitlines():
+                    linetime = file.gettime(line) or linetime
+                    stream.append((file, linetime, line))
+                streams.append(stream)
+            return streams
+
+    streams = itertools.chain.from_iterable(utils.parallel(collect, ships.values()))
+    # lines are decorated with stream and line numbers to merge them by time keeping the order
+    # of lines with same time and to never compare files (heapq.merge has no key in python 3.4)
+    merged = heapq.merge(*[[(item[1], i, j, item) for j, item in enumerate(stream)]
+                           for i, stream in enumerate(streams)])
+    return [item for _, _, _, item in merged]
@@ -1,4 +1,8 @@
 import functools
+import hashlib
+import bisect
+import fnmatch
+import re
 import itertools
 import inspect
 import string
@@ -7,10 +11,13 @@ import os.path
 import glob
 import threading
 import contextlib
+import collections
+import difflib
+import json
+import time
+import tempfile
 
-import pkg_resources
 import yaml
-import docker
 import mergedict
 
 try:
@@ -21,7 +28,8 @@ except ImportError:
 
 # import PtyInterceptor to make it accessible from utils package
 from .pty import PtyInterceptor
-PtyInterceptor  # to avoid flake8 warning
+from .version import __version__
+PtyInterceptor, __version__  # to avoid flake8 warning
 
 
 def getlogger():
@@ -55,13 +63,14 @@ class ThreadLocalInjector(logging.Filter):
 @contextlib.contextmanager
 def addcontext(**kwargs):
     try:
-        prevcontext = vars(tl)
+        prevcontext = vars(tl).copy()
         for key, value in kwargs.items():
             setattr(tl, key, value)
         yield
     finally:
         for key, value in kwargs.items():
-            delattr(tl, key)
+            if hasattr(tl, key):
+                delattr(tl, key)
         for key, value in prevcontext.items():
             setattr(tl, key, value)
 
@@ -118,6 +127,10 @@ class PrettyDictInjector(logging.Filter):
         return True
 
 
+# Loader for object-tagged documents (shipments, settings), C implementation is much faster
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+
 def cached(fun):
     return functools.lru_cache(100)(fun)
 
@@ -149,8 +162,146 @@ asdict = _as(dict)
 aslist = _as(list)
 
 
+def parallel(func, objects, workers=None):
+    """Calls func for every object using thread pool and returns list of results
+    in the same order. Thread local context (logger, ship, container, etc.)
+    of the calling thread is propagated to workers.
+    """
+    import concurrent.futures
+    objects = list(objects)
+    if not objects:
+        return []
+    workers = workers or settings.get('parallel.workers', 16)
+    context = dict(vars(tl))
+
+    def call(obj):
+        with addcontext(**context):
+            return func(obj)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(objects))) as executor:
+        return list(executor.map(call, objects))
+
+
+class NameIndex:
+    """Sorted index of objects by `fullname` for pattern filtering. Names are computed only once and
+    wildcard patterns check only names starting with the literal prefix of pattern (e.g. 'web' for 'web*:*').
+    """
+    def __init__(self, objects):
+        pairs = sorted(((obj.fullname, obj) for obj in objects), key=lambda pair: pair[0])
+        self.names = [name for name, _ in pairs]
+        self.objects = [obj for _, obj in pairs]
+
+    def filter(self, pattern, regex=False):
+        """Returns list of objects with fullname matching wildcard (or regex) pattern sorted by fullname"""
+        if regex:
+            prefix = ''
+        else:
+            prefix = re.split(r'[*?[]', pattern, 1)[0]
+            pattern = fnmatch.translate(pattern)
+        match = re.compile(pattern).match
+        result = []
+        for pos in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[pos]
+            if not name.startswith(prefix):
+                break
+            if match(name):
+                result.append(self.objects[pos])
+        return result
+
+
+def selectsegments(names, pattern, regex=False):
+    """Returns names of first fullname segments (e.g. ship names) which objects with fullnames matching
+    `pattern` could belong to, i.e. ones matching the literal prefix of wildcard pattern (all for regex).
+    """
+    if regex:
+        return list(names)
+    prefix = re.split(r'[*?[]', pattern, 1)[0]
+    if ':' in prefix:
+        return [name for name in names if name == prefix.split(':', 1)[0]]
+    return [name for name in names if name.startswith(prefix)]
+
+
+class SegmentIndex:
+    """Index of objects split by the first segment of fullname (e.g. ship name). `segments` is dict of
+    segment names to functions returning their objects, `NameIndex` of segment is built only when
+    pattern could match its objects, so 'web1:*' doesn't compute fullnames of objects of other segments.
+    """
+    def __init__(self, segments):
+        # segments are ordered as their fullnames, e.g. 'web10:app' goes before 'web1:app'
+        self.segments = collections.OrderedDict(sorted(segments.items(), key=lambda item: item[0] + ':'))
+        self.indexes = {}
+
+    def filter(self, pattern, regex=False):
+        """Returns list of objects with fullname matching wildcard (or regex) pattern sorted by fullname"""
+        result = []
+        for name in selectsegments(self.segments, pattern, regex):
+            if name not in self.indexes:
+                self.indexes[name] = NameIndex(self.segments[name]())
+            result.extend(self.indexes[name].filter(pattern, regex))
+        return result
+
+
+class WorkQueue:
+    """Thread safe deduplicating work queue. Item put while it is already waiting is ignored,
+    item put while it is being processed is queued again when `done` is called for it.
+    Items are handed out not more often than `rate` per second (if provided).
+    """
+    def __init__(self, rate=None):
+        self._cond = threading.Condition()
+        self._queued = collections.OrderedDict()
+        self._processing = set()
+        self._dirty = set()
+        self._interval = 1 / rate if rate else 0
+        self._next = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queued)
+
+    def put(self, item):
+        with self._cond:
+            if item in self._processing:
+                self._dirty.add(item)
+            elif item not in self._queued:
+                self._queued[item] = time.time()
+                self._cond.notify()
+
+    def get(self):
+        """Waits for item and returns pair (item, time it was put)"""
+        with self._cond:
+            while True:
+                delay = self._next - time.time()
+                if self._queued and delay <= 0:
+                    break
+                self._cond.wait(delay if self._queued else None)
+            item, queued = self._queued.popitem(last=False)
+            self._processing.add(item)
+            self._next = time.time() + self._interval
+            if self._queued:
+                # wake up another waiting worker
+                self._cond.notify()
+            return item, queued
+
+    def done(self, item):
+        with self._cond:
+            self._processing.discard(item)
+            if item in self._dirty:
+                self._dirty.discard(item)
+                self._queued[item] = time.time()
+                self._cond.notify()
+
+
+def humansize(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}TB'.format(size)
+
+
 @cached
 def getdocker(url=None):
+    import docker
     url = url or settings.get('docker.url', default=None)
     getlogger().debug('creating docker client', url=url)
     return docker.Client(url)
@@ -162,8 +313,11 @@ def compare_env(expected: dict, actual: dict):
     for name, value in actual.items():
         if name not in expected:
             yield ('env', name), ('', value or '""')
-        elif str(expected[name]) != value:
-            yield ('env', name), (expected[name], value or '""')
+        else:
+            expected_value = expected[name]
+            # actual values are always strings, so stringify expected one only if it's not
+            if expected_value != value and (isinstance(expected_value, str) or str(expected_value) != value):
+                yield ('env', name), (expected_value, value or '""')
 
     for name, value in expected.items():
         if name not in actual:
@@ -173,21 +327,17 @@ def compare_env(expected: dict, actual: dict):
 @aslist
 def compare_ports(cont, actual: dict):
     getlogger().debug('comparing ports')
+    portspecs = set()
     for name, door in cont.doors.items():
-        extport_expected = door.externalport
-
-        matched_actual = [info for name, info in actual.items()
-                          if name == door.portspec]
-
-        if len(matched_actual) == 0:
+        portspecs.add(door.portspec)
+        matched_actual = actual.get(door.portspec)
+        if matched_actual is None:
             yield ('ports',), (name, '')
         else:
-            yield from compare_values(('ports', name, 'ext'), extport_expected, int(matched_actual[0][0]['HostPort']))
+            yield from compare_values(('ports', name, 'ext'), door.externalport, int(matched_actual[0]['HostPort']))
 
-    for portname, portinfo in actual.items():
-        matched_expected = [name for name, door in cont.doors.items()
-                            if portname == door.portspec]
-        if len(matched_expected) == 0:
+    for portname in actual:
+        if portname not in portspecs:
             port, proto = portname.split('/', 1)
             yield ('ports',), ('', port)
 
@@ -195,14 +345,17 @@ def compare_ports(cont, actual: dict):
 @aslist
 def compare_volumes(cont, cinfo):
     getlogger().debug('comparing volumes')
+    volumes = {}
+    for volume in cont.volumes.values():
+        volumes.setdefault(volume.dest, volume)
+
     for dest, path in cinfo['Volumes'].items():
         ro = not cinfo['VolumesRW'][dest]
-        matched_expected = [volume for volume in cont.volumes.values() if volume.dest == dest]
-        if len(matched_expected) == 0:
+        volume = volumes.get(dest)
+        if volume is None:
             if not path.startswith('/var/lib/docker/vfs/dir'):
                 yield ('volumes',), ('', dest)
         else:
-            volume = matched_expected[0]
             with addcontext(volume=volume):
                 getlogger().debug('comparing volume')
 
@@ -215,8 +368,7 @@ def compare_volumes(cont, cinfo):
                     yield ('volumes', dest, 'ro'), (volume.ro, ro)
 
     for volume in cont.volumes.values():
-        matched_actual_path = [path for dest, path in cinfo['Volumes'].items() if dest == volume.dest]
-        if len(matched_actual_path) == 0:
+        if volume.dest not in cinfo['Volumes']:
             yield ('volumes',), (volume.dest, '')
 
 
@@ -257,13 +409,118 @@ def compare_container(cont, cinfo):
     yield from compare_volumes(cont, cinfo)
 
 
+# Texts with more lines are compared using unified diff instead of slow difflib.Differ
+FINEDIFF_MAXLINES = 200
+
+
+def difftext(actual, expected, maxlines=None):
+    """Returns changed lines of text diff in difflib.Differ format.
+    Small texts are compared using difflib.Differ to get intraline hints,
+    larger ones using much faster unified diff, hunk headers are returned as hints.
+    If `maxlines` is provided, diff is truncated to it.
+    """
+    actual = actual.split('\n')
+    expected = expected.split('\n')
+    if len(actual) + len(expected) <= FINEDIFF_MAXLINES:
+        diff = (line for line in difflib.Differ().compare(actual, expected) if line[:2] != '  ')
+    else:
+        diff = unifieddiff(actual, expected)
+
+    if maxlines is None:
+        return list(diff)
+    lines = list(itertools.islice(diff, maxlines + 1))
+    if len(lines) > maxlines:
+        lines[maxlines:] = ['? diff is truncated to {} lines'.format(maxlines)]
+    return lines
+
+
+def unifieddiff(actual, expected):
+    diff = difflib.unified_diff(actual, expected, n=0, lineterm='')
+    # skip ---/+++ header
+    for line in itertools.islice(diff, 2, None):
+        if line.startswith('@@'):
+            yield '? ' + line
+        else:
+            yield line[0] + ' ' + line[1:]
+
+
+@aslist
+def compare_definitions(old, new):
+    """Compares two definitions of the same container without contacting ship.
+    Yields diff in the same format as compare_container, treating `new` as expected.
+    """
+    getlogger().debug('comparing container definitions')
+    for key, expected, actual in [
+        ('image', new.image.gethash(), old.image.gethash()),
+        ('command', new.command, old.command),
+        ('hostname', new.hostname, old.hostname),
+        ('memory', new.memory, old.memory),
+        ('network_mode', new.network_mode, old.network_mode),
+        ('user', new.user, old.user),
+        ('privileged', new.privileged, old.privileged),
+    ]:
+        yield from compare_values((key,), expected, actual)
+
+    for name in sorted(set(new.env).union(old.env)):
+        yield from compare_values(('env', name), new.env.get(name, ''), old.env.get(name, ''))
+
+    for name in sorted(set(new.doors).union(old.doors)):
+        if name not in new.doors:
+            yield ('doors',), ('', name)
+        elif name not in old.doors:
+            yield ('doors',), (name, '')
+        else:
+            for attr in ['portspec', 'externalport', 'exposed']:
+                yield from compare_values(('doors', name, attr),
+                                          getattr(new.doors[name], attr), getattr(old.doors[name], attr))
+
+    newvolumes = {volume.dest: volume for volume in new.volumes.values()}
+    oldvolumes = {volume.dest: volume for volume in old.volumes.values()}
+    for dest in sorted(set(newvolumes).union(oldvolumes)):
+        if dest not in newvolumes:
+            yield ('volumes',), ('', dest)
+        elif dest not in oldvolumes:
+            yield ('volumes',), (dest, '')
+        else:
+            yield from compare_volume_definitions(oldvolumes[dest], newvolumes[dest])
+
+
+def compare_volume_definitions(old, new):
+    yield from compare_values(('volumes', new.dest, 'type'), type(new).__name__, type(old).__name__)
+    yield from compare_values(('volumes', new.dest, 'path'), new.fullpath, old.fullpath)
+    yield from compare_values(('volumes', new.dest, 'ro'), new.ro, old.ro)
+    newfiles = getattr(new, 'files', {})
+    oldfiles = getattr(old, 'files', {})
+    for name in sorted(set(newfiles).union(oldfiles)):
+        if name not in newfiles:
+            yield ('volumes', new.dest, 'files'), ('', name)
+        elif name not in oldfiles:
+            yield ('volumes', new.dest, 'files'), (name, '')
+        elif hasattr(type(newfiles[name]), 'data') and hasattr(type(oldfiles[name]), 'data'):
+            if newfiles[name].digest != oldfiles[name].digest:
+                yield ('volumes', new.dest, 'files', name), difftext(oldfiles[name].rendered.decode(),
+                                                                     newfiles[name].rendered.decode())
+
+
 def docker_lines(records):
-    buf = ''
+    """Splits stream of byte chunks (docker stream frames) into decoded lines in linear time.
+    Lines are decoded as a whole, so multibyte characters split between frames are kept intact.
+    """
+    pending = []
     for record in records:
-        buf += record.decode(errors='ignore')
-        while '\n' in buf:
-            line, buf = buf.split('\n', 1)
-            yield line
+        if b'\n' not in record:
+            pending.append(record)
+            continue
+        lines = record.split(b'\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+        rest = lines.pop()
+        pending = [rest] if rest else []
+        for line in lines:
+            yield line.decode(errors='replace')
+    if pending:
+        yield b''.join(pending).decode(errors='replace')
 
 
 def getcallingmodule(deep):
@@ -272,6 +529,7 @@ def getcallingmodule(deep):
 
 
 def resource_string(name):
+    import pkg_resources
     return pkg_resources.resource_string(getcallingmodule(1).__name__, name).decode()
 
 
@@ -294,6 +552,182 @@ def make_shipment(name):
     return decorator
 
 
+@contextlib.contextmanager
+def atomicwrite(path, mode='w'):
+    """Opens temporary file near `path` for writing and replaces `path` with it on success, so
+    readers never see partially written file if writer fails or is interrupted.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(f.name)
+        raise
+
+
+def getcachepath(*parts):
+    """Returns path inside dominator cache directory (`cachedir` setting)"""
+    return os.path.join(os.path.expanduser(settings.get('cachedir', os.path.join(settings.dirpath, 'cache'))), *parts)
+
+
+class StateCache:
+    """Persistent cache of observed state stored as JSON file. Every entry
+    is a dict with values and `timestamp` of the moment it was observed.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self._dict = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._dict = {}
+
+    def get(self, key, maxage):
+        """Returns entry if it's not older than `maxage` seconds"""
+        entry = self._dict.get(key)
+        if entry is None or time.time() - entry['timestamp'] > maxage:
+            return None
+        return entry
+
+    def set(self, key, **values):
+        values['timestamp'] = time.time()
+        self._dict[key] = values
+
+    def save(self):
+        getlogger().debug('saving state cache', path=self.path)
+        with atomicwrite(self.path) as f:
+            json.dump(self._dict, f)
+
+
+def tailfile(path, inode, offset, restart, limit):
+    """Reads at most `limit` bytes of file from `offset` if it has the same `inode` (as string) and is
+    not truncated. Otherwise reads it from the beginning if `restart` is set or reads nothing.
+    Empty `inode` means that file wasn't read yet, so it is read from `offset` bytes before its end.
+    Returns tuple (inode, size, start, data), inode is '-' for missing file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            start = offset
+            if not inode:
+                start = max(stat.st_size - offset, 0)
+            elif str(stat.st_ino) != inode or stat.st_size < offset:
+                start = 0 if restart else stat.st_size
+            count = min(stat.st_size - start, limit)
+            f.seek(start)
+            data = f.read(count)
+            return str(stat.st_ino), stat.st_size, start, data + b'\0' * (count - len(data))
+    except FileNotFoundError:
+        return '-', 0, 0, b''
+
+
+def archive_lines(directory, lines, keep=0):
+    """Appends pairs (timestamp, line) to daily rotated gzipped files `<directory>/<date>.log.gz`
+    (every append adds gzip member, which is still valid gzip file). Keeps only `keep` newest
+    files if `keep` is not 0. Returns number of lines written.
+    """
+    import gzip
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    for date, group in itertools.groupby(lines, key=lambda pair: pair[0][:10]):
+        with gzip.open(os.path.join(directory, date + '.log.gz'), 'at') as f:
+            for timestamp, line in group:
+                f.write('{} {}\n'.format(timestamp, line))
+                count += 1
+    if keep:
+        for path in sorted(glob.glob(os.path.join(directory, '*.log.gz')))[:-keep]:
+            getlogger().debug('removing rotated log archive', path=path)
+            os.remove(path)
+    return count
+
+
+def loadcache(path, key):
+    """Returns object from pickled cache file if it was saved with the same `key` and files
+    it depends on are not modified since then (see `savecache`), otherwise None
+    """
+    import pickle
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != key:
+                getlogger().debug('cache is outdated', path=path)
+                return None
+            for filename, mtime in pickle.load(f):
+                if os.path.getmtime(filename) != mtime:
+                    getlogger().debug('cache is outdated', path=path, modified=filename)
+                    return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # cache could be broken or could contain objects of changed classes
+        getlogger().warning('failed to load cache, ignoring', path=path, error=e)
+        return None
+
+
+def savecache(path, key, obj, files=()):
+    """Saves pickled object to cache file along with `key` and modification times of `files`
+    object depends on (e.g. modules of pickled classes), see `loadcache`
+    """
+    import pickle
+    getlogger().debug('saving cache', path=path)
+    try:
+        with atomicwrite(path, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump([(filename, os.path.getmtime(filename)) for filename in files], f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        getlogger().warning('failed to save cache, ignoring', path=path, error=e)
+
+
+class TemplateCache:
+    """Process-wide cache of compiled Mako templates by digest of their source, so template
+    shared by many files (or rendered many times) is compiled only once. If `templatedir`
+    setting is set, templates are also compiled to Mako module directory to survive between runs.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, text):
+        key = hashlib.sha1(text.encode()).hexdigest()
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.hits += 1
+                return template
+            self.misses += 1
+            template = self.templates[key] = self.compile(text, key)
+        getlogger().debug('compiled template', digest=key, hits=self.hits, misses=self.misses)
+        return template
+
+    def compile(self, text, key):
+        import mako.template
+        directory = settings.get('templatedir', None)
+        if directory is None:
+            return mako.template.Template(text)
+        directory = os.path.expanduser(directory)
+        filename = os.path.join(directory, key + '.mako')
+        if not os.path.exists(filename):
+            with atomicwrite(filename) as f:
+                f.write(text)
+        # Mako compiles template to module file near it and reuses it while template file is not changed
+        return mako.template.Template(filename=filename, module_directory=directory, uri=key + '.mako')
+
+    def logstats(self):
+        if self.hits or self.misses:
+            getlogger().debug('template cache stats', hits=self.hits, misses=self.misses,
+                              hitrate='{:.0%}'.format(self.hits / (self.hits + self.misses)))
+
+
+templates = TemplateCache()
+
+
 NONEXISTENT_KEY = object()
 
 
@@ -311,10 +745,10 @@ class Settings:
                 getlogger().debug("checking existense of %s", filename)
                 if os.path.exists(filename):
                     getlogger().info("loading settings from %s", filename)
-                    data = yaml.load(open(filename))
+                    data = yaml.load(open(filename), Loader=YamlLoader)
                     self._dict.merge(data)
         else:
-            data = yaml.load(file)
+            data = yaml.load(file, Loader=YamlLoader)
             self._dict.merge(data)
 
     def get(self, path, default=NONEXISTENT_KEY, type_=None, help=None):
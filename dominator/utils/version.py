@@ -0,0 +1,2 @@
+# Version of dominator, it is read by setup.py and updated by bumpversion
+__version__ = '9.1.0'
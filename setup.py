@@ -1,3 +1,5 @@
+import os.path
+import re
 import sys
 import setuptools
 from setuptools.command.test import test as TestCommand
@@ -22,10 +24,16 @@ class PyTest(TestCommand):
         sys.exit(errno)
 
 
+def getversion():
+    # version module is read instead of importing it, as dominator dependencies may be not installed yet
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dominator', 'utils', 'version.py')) as f:
+        return re.search(r"^__version__ = '(.*)'$", f.read(), re.M).group(1)
+
+
 if __name__ == '__main__':
     setuptools.setup(
         name='dominator',
-        version='9.1.0',
+        version=getversion(),
         url='https://github.com/yandex-sysmon/dominator',
         license='LGPLv3',
         author='Nikolay Bryskin',
@@ -48,7 +56,7 @@ if __name__ == '__main__':
             'Topic :: System :: Distributed Computing',
         ],
         install_requires=[
-            'docker-py >= 0.5.0',
+            'docker-py >= 1.5.0',
             'mako',
             'colorama',
             'click',
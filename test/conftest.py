@@ -0,0 +1,142 @@
+import copy
+
+import pytest
+
+from dominator import entities
+from dominator.utils import settings as _settings
+
+
+@pytest.yield_fixture(autouse=True)
+def settings():
+    """Global settings, which are restored after test, so values set by test don't leak into others"""
+    saved = copy.deepcopy(_settings._dict)
+    try:
+        yield _settings
+    finally:
+        _settings._dict = saved
+
+
+class FakeDocker:
+    """Fake docker client which records calls. `logs` and `events` yield items of `streams`
+    (list of (items, error) pairs) one stream per call, raising error after items if it is set.
+    """
+    def __init__(self, containers=(), images=(), streams=(), errors=None):
+        self._containers = list(containers)
+        self._images = list(images)
+        self.streams = list(streams)
+        # ids of containers and images which removal fails with given http status code
+        self.errors = errors or {}
+        self.since = []
+        self.removed = []
+        self.calls = []
+
+    def containers(self, all=False, size=False):
+        return [cinfo for cinfo in self._containers if all or 'Up' in cinfo['Status']]
+
+    def images(self, name=None, all=False):
+        return self._images
+
+    def inspect_container(self, id):
+        return {'id': id}
+
+    def _remove(self, id):
+        if id in self.errors:
+            import docker.errors
+            import requests
+            response = requests.Response()
+            response.status_code = self.errors[id]
+            raise docker.errors.APIError('removal failed', response=response, explanation='removal failed')
+        self.removed.append(id)
+
+    def remove_container(self, id, v=False, force=False):
+        self._remove(id)
+
+    def remove_image(self, id):
+        self._remove(id)
+
+    def create_container(self, name, **kwargs):
+        self.calls.append(('create', name))
+        return {'Id': 'new', 'Warnings': None}
+
+    def stop(self, id, timeout):
+        self.calls.append(('stop', id))
+
+    def rename(self, id, name):
+        self.calls.append(('rename', id, name))
+
+    def start(self, id, **kwargs):
+        self.calls.append(('start', id))
+
+    def _stream(self, since):
+        self.since.append(since)
+        items, error = self.streams.pop(0)
+        yield from items
+        if error:
+            raise error
+
+    def logs(self, id, stream, follow, timestamps, tail, since):
+        yield from self._stream(since)
+
+    def events(self, since=None, decode=False):
+        yield from self._stream(since)
+
+
+class FakeShip(entities.Ship):
+    docker = None
+
+
+class FakeLocalShip(entities.LocalShip):
+    docker = None
+
+
+@pytest.fixture
+def fakedocker():
+    """FakeDocker class to make docker clients with containers, images and streams"""
+    return FakeDocker
+
+
+@pytest.fixture
+def fakeship():
+    """FakeShip class to make ships with own docker client (`docker` attr)"""
+    return FakeShip
+
+
+@pytest.fixture
+def ship():
+    """Ship 'ship1' with empty fake docker"""
+    ship = FakeShip('ship1', 'ship1.example.com')
+    ship.docker = FakeDocker()
+    return ship
+
+
+@pytest.fixture
+def localship():
+    """LocalShip with empty fake docker"""
+    ship = FakeLocalShip()
+    ship.docker = FakeDocker()
+    return ship
+
+
+@pytest.fixture
+def make_shipment(ship):
+    """Factory of shipment 'testshipment' with backrefs made. Containers with given names ('web' by default)
+    are placed on `ship` and use image 'web', other keyword arguments are passed to every container.
+    """
+    def make_shipment(*names, **kwargs):
+        kwargs.setdefault('ship', ship)
+        kwargs.setdefault('image', entities.Image('web', id='img', namespace=None))
+        shipment = entities.Shipment(name='testshipment', containers=[
+            # every container gets own mappings (e.g. volumes), as if they were constructed separately
+            entities.Container(name=name, **{key: dict(value) if isinstance(value, dict) else value
+                                             for key, value in kwargs.items()})
+            for name in names or ['web']
+        ])
+        shipment.make_backrefs()
+        return shipment
+    return make_shipment
+
+
+@pytest.fixture
+def container(make_shipment):
+    """Container 'web' on `ship` in shipment made by `make_shipment`"""
+    return make_shipment().ships['ship1'].containers['web']
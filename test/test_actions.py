@@ -12,24 +12,23 @@ from click.testing import CliRunner
 
 from dominator import entities
 from dominator import actions
-from dominator.utils import settings as _settings
 
 
 vcr = VCR(cassette_library_dir='test/fixtures/vcr_cassettes')
 
 
 @pytest.yield_fixture(autouse=True)
-def settings():
-    _settings['configvolumedir'] = '/tmp/dominator-test-config'
+def settings(settings):
+    settings['configvolumedir'] = '/tmp/dominator-test-config'
     # FIXME: use https endpoint because vcrpy doesn't handle UnixHTTPConnection
-    _settings['docker.url'] = 'http://localhost:4243'
-    _settings['docker.namespace'] = 'yandex'
+    settings['docker.url'] = 'http://localhost:4243'
+    settings['docker.namespace'] = 'yandex'
 
     try:
-        os.mkdir(_settings['configvolumedir'])
-        yield _settings
+        os.mkdir(settings['configvolumedir'])
+        yield settings
     finally:
-        shutil.rmtree(_settings['configvolumedir'], ignore_errors=True)
+        shutil.rmtree(settings['configvolumedir'], ignore_errors=True)
 
 
 @pytest.fixture(autouse=True)
@@ -128,3 +127,198 @@ def test_makedeb(shipment, tmpdir):
         result = runner.invoke(actions.shipment, ['makedeb', 'test-package', 'trusty', 'high'], obj=shipment)
         assert result.exit_code == 0
         assert os.path.isdir('debian')
+
+
+def test_status_cache(tmpdir, settings, ship, container, fakedocker):
+    settings['cachedir'] = str(tmpdir)
+    shipment = container.ship.shipment
+    ship.docker = fakedocker(containers=[{'Id': 'c1', 'Names': ['/testshipment.web'], 'Status': 'Up 1 hour',
+                                          'Labels': {entities.FINGERPRINT_LABEL: container.getfingerprint()}}])
+
+    runner = CliRunner()
+    result = runner.invoke(actions.container, ['status', '-m', '60'], obj=shipment)
+    assert result.exit_code == 0
+    assert 'cached' not in result.output
+    assert tmpdir.join('status', 'testshipment.json').check()
+
+    ship.docker = None
+    result = runner.invoke(actions.container, ['status', '-m', '60'], obj=shipment)
+    assert result.exit_code == 0
+    assert re.match(r'ship1:web[ \t]+c1[ \t]+Up 1 hour[ \t]+.*\(cached 0s ago\)', result.output)
+
+
+def test_gc(fakeship, fakedocker, make_shipment):
+    ships = [fakeship(name, name + '.example.com') for name in ['ship1', 'ship2']]
+    for ship in ships:
+        ship.docker = fakedocker(containers=[
+            {'Id': 'c1', 'Names': ['/testshipment.old'], 'Status': 'Exited (0)', 'Image': 'web:img', 'SizeRw': 1024}])
+    ships[0].docker.errors = {'c1': 500}
+    shipment = make_shipment('web')
+    for ship in ships:
+        ship.containers = {}
+        ship.shipment = shipment
+    shipment.ships = {ship.name: ship for ship in ships}
+
+    # failure on one ship doesn't stop gc on others
+    result = CliRunner().invoke(actions.ship, ['gc'], obj=shipment)
+    assert result.exit_code == 0
+    assert result.output.splitlines()[:2] == ['ship1           failed',
+                                              'ship2               1 containers     0 images      1.0KB']
+    assert ships[1].docker.removed == ['c1']
+
+
+def test_archive(tmpdir, ship, container, fakedocker):
+    import gzip
+
+    shipment = container.ship.shipment
+    log = b'1970-01-01T00:00:10Z first\n1970-01-02T00:00:10Z second\n'
+    ship.docker = fakedocker(containers=[{'Id': 'c1', 'Names': ['/testshipment.web'], 'Status': 'Up 1 hour'}],
+                             streams=[([log], None)])
+
+    runner = CliRunner()
+    result = runner.invoke(actions.container, ['archive', '-o', str(tmpdir)], obj=shipment)
+    assert result.exit_code == 0
+    assert '2 lines' in result.output
+    archive = tmpdir.join('testshipment', 'ship1', 'web')
+    assert sorted(path.basename for path in archive.listdir()) == ['1970-01-01.log.gz', '1970-01-02.log.gz']
+
+    # rerun fetches only lines after the cursor, including new ones with the cursor timestamp
+    ship.docker.streams.append(([log + b'1970-01-02T00:00:10Z again\n1970-01-02T00:00:11Z third\n'], None))
+    result = runner.invoke(actions.container, ['archive', '-o', str(tmpdir), '-k', '1'], obj=shipment)
+    assert '2 lines' in result.output
+    assert ship.docker.since == [None, 86410]
+    assert [path.basename for path in archive.listdir()] == ['1970-01-02.log.gz']
+    with gzip.open(str(archive.join('1970-01-02.log.gz')), 'rt') as f:
+        assert f.read() == '1970-01-02T00:00:10Z second\n1970-01-02T00:00:10Z again\n1970-01-02T00:00:11Z third\n'
+
+
+def test_loadshipment_cache(tmpdir, monkeypatch, settings, make_shipment):
+    settings['cachedir'] = str(tmpdir.join('cache'))
+    config = tmpdir.join('shipment.yaml')
+    config.write(yaml.dump(make_shipment(ship=entities.Ship('ship1', 'ship1.example.com'), volumes={
+        'config': entities.ConfigVolume('/etc', {'a.conf': entities.TextFile('a')})})))
+
+    shipment = actions.loadshipment(config.open())
+    assert next(shipment.files).volume.container.ship is shipment.ships['ship1']
+    assert len(tmpdir.join('cache', 'shipments').listdir()) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('yaml should not be parsed')
+    monkeypatch.setattr(yaml, 'load', fail)
+    cached = actions.loadshipment(config.open())
+    assert [c.fullname for c in cached.containers] == ['ship1:web']
+    assert next(cached.files).volume.container.ship is cached.ships['ship1']
+
+    monkeypatch.undo()
+    config.write(config.read().replace('testshipment', 'othershipment'))
+    assert actions.loadshipment(config.open()).name == 'othershipment'
+
+
+def test_loadshipment_cache_modules(tmpdir, monkeypatch, settings, make_shipment):
+    settings['cachedir'] = str(tmpdir.join('cache'))
+    module = tmpdir.mkdir('site').join('obedient_cachetest.py')
+    module.write('from dominator.entities import Container\n\n\nclass WebContainer(Container):\n    __slots__ = ()\n')
+    monkeypatch.syspath_prepend(str(module.dirpath()))
+    from obedient_cachetest import WebContainer
+
+    config = tmpdir.join('shipment.yaml')
+    shipment = make_shipment(ship=entities.Ship('ship1', 'ship1.example.com'))
+    shipment.ships['ship1'].containers['web'].__class__ = WebContainer
+    config.write(yaml.dump(shipment))
+    assert module.strpath in actions.ShipmentFile(config.open()).getmodulefiles()
+    actions.loadshipment(config.open())
+
+    parsed = []
+    monkeypatch.setattr(yaml, 'load', lambda *args, **kwargs: parsed.append(True))
+    assert type(next(actions.loadshipment(config.open()).containers)) is WebContainer
+    assert parsed == []
+    # modification of module with class used by shipment outdates the cache
+    module.setmtime(module.mtime() + 10)
+    with pytest.raises(AttributeError):
+        actions.loadshipment(config.open())
+    assert parsed == [True]
+
+
+def test_dump_output(tmpdir, make_shipment):
+    def make_dumped():
+        # dump detaches containers from ships, so every dump needs fresh shipment
+        return make_shipment('web', 'db', ship=entities.Ship('ship1', 'ship1.example.com'))
+    output = tmpdir.join('dump.yaml')
+
+    result = CliRunner().invoke(actions.container, ['dump', '-o', str(output)], obj=make_dumped())
+    assert result.exit_code == 0
+    assert [container.name for container in yaml.load_all(output.read(), Loader=yaml.Loader)] == ['db', 'web']
+
+    # not a terminal, so no pager is used
+    result = CliRunner().invoke(actions.container, ['dump'], obj=make_dumped())
+    assert result.output.count('--- !!python/object:dominator.entities.Container') == 2
+
+
+def test_partial_load(tmpdir, settings):
+    settings['cachedir'] = str(tmpdir.join('cache'))
+    ships = [entities.Ship(name, name + '.example.com') for name in ['web1', 'web2', 'db']]
+    config = tmpdir.join('shipment.yaml')
+    config.write(yaml.dump(entities.Shipment(name='testshipment', containers=[
+        entities.Container(name='app', ship=ship, image=entities.Image('web', id='img', namespace=None))
+        for ship in ships
+    ])))
+    # first load builds cache
+    assert len(actions.ShipmentFile(config.open()).load('web1:*').ships) == 3
+
+    shipment = actions.ShipmentFile(config.open()).load('web1:*')
+    assert list(shipment.ships) == ['web1']
+    assert next(shipment.containers).ship.shipment is shipment
+    shipment = actions.ShipmentFile(config.open()).load('web*')
+    assert sorted(shipment.ships) == ['web1', 'web2']
+    assert {ship.shipment for ship in shipment.ships.values()} == {shipment}
+    assert len(actions.ShipmentFile(config.open()).load('*:app').ships) == 3
+    assert len(actions.ShipmentFile(config.open()).load('web1', regex=True).ships) == 3
+
+    result = CliRunner().invoke(actions.container, ['list'], obj=actions.ShipmentFile(config.open()))
+    assert result.output == 'db:app\nweb1:app\nweb2:app\n'
+    result = CliRunner().invoke(actions.container, ['-p', 'db:*', 'list'], obj=actions.ShipmentFile(config.open()))
+    assert result.output == 'db:app\n'
+
+    # commands rendering or changing objects get full shipment
+    def isreadonly(*args):
+        return actions.container.isreadonly(actions.container.make_context('container', list(args)))
+    assert isreadonly('-p', 'db:*', 'list', 'log', '-n', '10')
+    assert not isreadonly('-p', 'db:*', 'list', 'start')
+    assert not isreadonly('status', '-d')
+
+
+def test_partial_load_crossship(tmpdir, settings):
+    settings['cachedir'] = str(tmpdir.join('cache'))
+    image = entities.Image('web', id='img', namespace=None)
+    db = entities.Container(name='db', ship=entities.Ship('db', 'db.example.com'), image=image)
+    web = entities.Container(name='app', ship=entities.Ship('web1', 'web1.example.com'), image=image, volumes={
+        'config': entities.ConfigVolume('/etc', {'app.conf': entities.TemplateFile('${db.name}', db=db)})})
+    config = tmpdir.join('shipment.yaml')
+    config.write(yaml.dump(entities.Shipment(name='testshipment', containers=[web, db])))
+
+    # partial shipment of web1 would pull db ship by template context, so shipment isn't split
+    assert len(actions.ShipmentFile(config.open()).load('web1:*').ships) == 2
+    assert len(actions.ShipmentFile(config.open()).load('web1:*').ships) == 2
+    assert [path.basename for path in tmpdir.join('cache', 'shipments').listdir()[0].listdir()] == ['shipment']
+
+
+def test_obedient_index(tmpdir, monkeypatch, settings):
+    settings['cachedir'] = str(tmpdir.join('cache'))
+    site = tmpdir.mkdir('site')
+    site.join('obedient_test.py').write('def make():\n    return "shipment"\n')
+    distinfo = site.mkdir('obedient.test-1.0.dist-info')
+    distinfo.join('METADATA').write('Metadata-Version: 2.1\nName: obedient.test\nVersion: 1.0\n')
+    distinfo.join('entry_points.txt').write('[obedient]\ntest = obedient_test:make\n')
+    monkeypatch.syspath_prepend(str(site))
+
+    actions.getobedientindex.cache_clear()
+    result = CliRunner().invoke(actions.shipment, ['generate'], obj=None)
+    assert 'obedient.test' in result.output.split()
+    result = CliRunner().invoke(actions.shipment, ['generate', 'obedient.test'], obj=None)
+    assert result.output == 'test\n'
+    assert actions.loadentrypoint(actions.getobedientindex()['obedient.test']['test'])() == 'shipment'
+
+    # index is loaded from cache while sys.path directories are not changed
+    monkeypatch.setattr('pkg_resources.Environment', None)
+    actions.getobedientindex.cache_clear()
+    assert 'obedient.test' in actions.getobedientindex()
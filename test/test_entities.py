@@ -0,0 +1,359 @@
+import os
+import datetime
+
+import pytest
+
+from dominator import entities
+from dominator import utils
+
+
+def test_getgarbage(ship, make_shipment, fakedocker):
+    dock = ship.docker = fakedocker(
+        containers=[
+            {'Id': 'c1', 'Names': ['/testshipment.web'], 'Status': 'Exited (0)', 'Image': 'web:img3'},
+            {'Id': 'c2', 'Names': ['/testshipment.old'], 'Status': 'Exited (0)', 'Image': 'web:img1', 'SizeRw': 10},
+            {'Id': 'c3', 'Names': ['/testshipment.db'], 'Status': 'Up 2 days', 'Image': 'web:img0'},
+            {'Id': 'c4', 'Names': ['/othershipment.old'], 'Status': 'Exited (0)', 'Image': 'other:latest'},
+            {'Id': 'c5', 'Names': ['/testshipment.restarting'], 'Status': 'Restarting (1) 2 seconds ago',
+             'Image': 'web:img0'},
+            {'Id': 'c6', 'Names': ['/testshipment.paused'], 'State': 'paused', 'Status': 'Up 2 days (Paused)',
+             'Image': 'web:img0'},
+            {'Id': 'c7', 'Names': ['/testshipment.new'], 'Status': '', 'Image': 'web:img0'},
+        ],
+        images=[
+            {'Id': 'img0', 'RepoTags': ['web:v0'], 'Created': 0, 'Size': 1},
+            {'Id': 'img1', 'RepoTags': ['web:v1'], 'Created': 1, 'Size': 2},
+            {'Id': 'img2', 'RepoTags': ['web:v2'], 'Created': 2, 'Size': 4},
+            {'Id': 'img3', 'RepoTags': ['web:v3'], 'Created': 3, 'Size': 8},
+            {'Id': 'img4', 'RepoTags': ['other:latest'], 'Created': 4, 'Size': 16},
+        ],
+    )
+    make_shipment(image=entities.Image('web', tag='v3', id='img3', namespace=None))
+
+    # only containers which are not going to run are garbage
+    containers, images = ship.getgarbage(keep=0)
+    assert [cinfo['Id'] for cinfo in containers] == ['c2', 'c7']
+    assert [iinfo['Id'] for iinfo in images] == ['img2', 'img1']
+
+    containers, images = ship.getgarbage(keep=1)
+    assert [iinfo['Id'] for iinfo in images] == ['img1']
+
+    assert ship.removegarbage(containers, images) == 12
+    assert dock.removed == ['c2', 'c7', 'img1']
+
+    # containers which are already removed or can't be removed are skipped
+    dock.removed = []
+    dock.errors = {'c2': 404, 'c7': 409}
+    assert ship.removegarbage(containers, images) == 2
+    assert dock.removed == ['img1']
+    dock.errors = {'c2': 500}
+    with pytest.raises(Exception):
+        ship.removegarbage(containers, images)
+
+
+def test_waitready(fakeship, make_shipment):
+    import socket
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    shipment = make_shipment('zk', ship=fakeship('ship1', '127.0.0.1'), doors={
+        'client': entities.Door('zookeeper', port=port),
+        'internal': entities.Door('zookeeper', port=1, exposed=False),
+    })
+    container = next(shipment.containers)
+    try:
+        assert list(container.waitready(timeout=1)) == ['client']
+    finally:
+        server.close()
+
+    with pytest.raises(TimeoutError):
+        container.waitready(timeout=0.1)
+
+
+def test_swap(tmpdir, settings, localship, make_shipment):
+    settings['configvolumedir'] = str(tmpdir)
+    ship = localship
+    container = next(make_shipment(ship=ship, volumes={
+        'config': entities.ConfigVolume(dest='/etc/web', files={'web.conf': entities.TextFile('new')})}).containers)
+    container.check({'Id': 'old', 'Status': 'Up 1 hour'})
+
+    assert container.swap() >= 0
+    assert ship.docker.calls == [
+        ('create', 'testshipment.web.staging'),
+        ('stop', 'old'),
+        ('rename', 'new', 'testshipment.web'),
+        ('start', 'new'),
+    ]
+    assert ship.docker.removed == ['old']
+    assert tmpdir.join('testshipment', 'web', 'etc', 'web', 'web.conf').read() == 'new'
+    assert not tmpdir.join('testshipment', 'web', 'etc', 'web.staging').check()
+    assert container.id == 'new'
+    assert container.running
+
+
+def test_plan(monkeypatch, ship, make_shipment, fakedocker):
+    ship.docker = fakedocker(containers=[
+        {'Id': 'c1', 'Names': ['/testshipment.same'], 'Status': 'Up 1 hour'},
+        {'Id': 'c2', 'Names': ['/testshipment.files'], 'Status': 'Up 1 hour'},
+        {'Id': 'c3', 'Names': ['/testshipment.changed'], 'Status': 'Up 1 hour'},
+        {'Id': 'c4', 'Names': ['/testshipment.stopped'], 'Status': 'Exited (0)'},
+    ])
+    shipment = make_shipment('same', 'files', 'changed', 'stopped', 'new')
+    diffs = {
+        'c1': [],
+        'c2': [(('volumes', '/etc', 'files', 'a.conf'), ['- a', '+ b'])],
+        'c3': [(('volumes', '/etc', 'files', 'a.conf'), ['- a', '+ b']), (('memory',), (0, 1))],
+    }
+    monkeypatch.setattr(utils, 'compare_container', lambda cont, cinfo: diffs[cinfo['id']])
+    actions = {cont.name: action for cont, action, _ in shipment.plan()}
+    assert actions == {'same': 'noop', 'files': 'rerender', 'changed': 'recreate', 'stopped': 'recreate',
+                       'new': 'create'}
+
+
+def test_fingerprint(ship, make_shipment, fakedocker):
+    container = next(make_shipment(volumes={
+        'config': entities.ConfigVolume(dest='/etc/web', files={'web.conf': entities.TextFile('content')})}).containers)
+    fingerprint = container.getfingerprint()
+    assert fingerprint == container.getfingerprint()
+
+    ship.docker = fakedocker(containers=[{'Id': 'c1', 'Names': ['/testshipment.web'], 'Status': 'Up 1 hour',
+                                          'Labels': {entities.FINGERPRINT_LABEL: fingerprint}}])
+    # running container with the same fingerprint is kept without inspecting
+    assert container.run() is None
+    assert container.id == 'c1'
+    assert container.isuptodate()
+    assert ship.docker.calls == []
+
+    container.volumes['config'].files['web.conf'].content = 'other content'
+    assert not container.isuptodate()
+
+    container.check({'Id': 'c1', 'Status': 'Up 1 hour', 'Labels': None})
+    assert container.actualfingerprint is None
+
+
+def test_stale_fingerprint(monkeypatch, container):
+    compared = []
+
+    def compare_container(cont, cinfo):
+        compared.append(cinfo['id'])
+        return []
+    monkeypatch.setattr(utils, 'compare_container', compare_container)
+
+    # label is stale (e.g. after rerender), but config is the same
+    container.check({'Id': 'c1', 'Status': 'Up 1 hour', 'Labels': {entities.FINGERPRINT_LABEL: 'stale'}})
+    assert container.getdiff() == []
+    assert compared == ['c1']
+
+    container.check({'Id': 'c1', 'Status': 'Up 1 hour',
+                     'Labels': {entities.FINGERPRINT_LABEL: container.getfingerprint()}})
+    assert container.getdiff() == []
+    assert compared == ['c1']
+
+
+def test_compare_file(tmpdir):
+    volume = entities.ConfigVolume(dest='/etc/web')
+    textfile = entities.TextFile('line1\nline2')
+    tmpdir.join('same').write('line1\nline2')
+    tmpdir.join('changed').write('line1\nother')
+    tmpdir.join('binary').write_binary(b'\0\1\2')
+
+    assert volume.compare_file('same', textfile, str(tmpdir.join('same'))) == []
+    assert volume.compare_file('changed', textfile, str(tmpdir.join('changed'))) == [
+        (('volumes', '/etc/web', 'files', 'changed'), ['- other', '+ line2'])]
+    assert volume.compare_file('binary', textfile, str(tmpdir.join('binary'))) == [
+        (('volumes', '/etc/web', 'files', 'binary'), ['? differs (3 bytes, expected 11 bytes)'])]
+    assert volume.compare_file('missing', textfile, str(tmpdir.join('missing'))) == [
+        (('volumes', '/etc/web', 'files'), ('missing', '<not found>'))]
+
+
+def test_events(ship, container, fakedocker):
+    def event(id, status, time):
+        return {'id': id, 'status': status, 'time': time, 'timeNano': time * 10**9}
+
+    ship.docker = fakedocker(streams=[
+        ([event('c1', 'create', 10), event('c1', 'start', 11)], ConnectionError()),
+        # resumed stream repeats event from the last second
+        ([event('c1', 'start', 11), event('c1', 'die', 12)], None),
+    ])
+    ship.docker.inspect_container = lambda id: {'Name': '/testshipment.web'}
+
+    events = ship.events()
+    received = [next(events) for _ in range(3)]
+    assert [e['status'] for e in received] == ['create', 'start', 'die']
+    assert ship.docker.since == [None, 11]
+
+    assert ship.getcontainer(received[0]) is container
+    assert container.handle_event(received[1])
+    assert container.id == 'c1' and container.running
+    assert ship.getcontainer(received[2]) is container
+    assert container.handle_event(received[2])
+    assert not container.running
+    assert not container.handle_event(event('c1', 'attach', 13))
+    assert container.handle_event(event('c1', 'destroy', 14))
+    assert container.id is None
+
+
+def test_follow(monkeypatch, ship, container, fakedocker):
+    monkeypatch.setattr(entities.time, 'sleep', lambda seconds: None)
+    ship.docker = fakedocker(containers=[{'Id': 'c1', 'Names': ['/testshipment.web'], 'Status': 'Up 1 hour'}], streams=[
+        ([b'1970-01-01T00:00:10Z first\n1970-01-01T00:00:10.5Z a\n1970-01-01T00:00:10.5Z b\n'], ConnectionError()),
+        # resumed stream repeats lines from the last second, new line could have the same timestamp
+        ([b'1970-01-01T00:00:10Z first\n1970-01-01T00:00:10.5Z a\n1970-01-01T00:00:10.5Z b\n'
+          b'1970-01-01T00:00:10.5Z c\n1970-01-01T00:00:11Z third\n'], None),
+    ])
+
+    lines = container.follow()
+    assert [next(lines) for _ in range(5)] == ['first', 'a', 'b', 'c', 'third']
+    assert ship.docker.since == [None, 10]
+
+    ship.docker.streams.append(([b'1970-01-01T00:00:10Z first\n'], None))
+    assert next(container.follow(timestamps=True)) == '1970-01-01T00:00:10Z first'
+
+
+def test_collectlogs(tmpdir, settings, fakeship, localship):
+    class ScriptShip(fakeship):
+        def getssh(self):
+            import subprocess
+
+            class SSH:
+                def run(self, script):
+                    return subprocess.run(['bash', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return SSH()
+
+    ship = ScriptShip('ship1', 'ship1.example.com', datadir=str(tmpdir))
+    shipment = entities.Shipment(name='testshipment', containers=[
+        entities.Container(name=name, ship=containership, image=entities.Image('web', id='img', namespace=None),
+                           volumes={'logs': entities.LogVolume(dest='/var/log', files={
+                               'app.log': entities.RotatedLogFile(format='%H:%M:%S')})})
+        for name, containership in [('web', ship), ('db', localship)]
+    ])
+    shipment.make_backrefs()
+    settings['datavolumedir'] = str(tmpdir)
+    web, db = [file.fullpath for file in shipment.files]
+    os.makedirs(os.path.dirname(web))
+    os.makedirs(os.path.dirname(db))
+    with open(web, 'w') as f:
+        f.write('09:59:59 old\n10:00:00 web1\n  continued\n10:00:02 web2\n10:00:0')
+    with open(db, 'w') as f:
+        f.write('09:59:59 {}\n10:00:01 db1\n'.format('old' * 20))
+
+    # files are read first time from their last bytes, partial first line is skipped
+    cursors = {}
+    lines = entities.collectlogs(shipment.files, cursors, tail=50)
+    assert [line for _, _, line in lines] == ['10:00:00 web1', '  continued', '10:00:01 db1', '10:00:02 web2']
+    assert entities.collectlogs(shipment.files, cursors) == []
+
+    with open(web, 'a') as f:
+        f.write('3 web3\n')
+    os.rename(web, web + '.1')
+    with open(web, 'w') as f:
+        f.write('10:00:04 web4\n')
+    # truncated file is read from the beginning
+    with open(db, 'w') as f:
+        f.write('10:00:05 d\n')
+    lines = entities.collectlogs(shipment.files, cursors)
+    assert [line for _, _, line in lines] == ['10:00:03 web3', '10:00:04 web4', '10:00:05 d']
+
+    # every call reads at most limit bytes, the rest is read by the next calls
+    with open(web, 'a') as f:
+        f.write('10:00:06 web6\n10:00:07 web7\n')
+    assert [line for _, _, line in entities.collectlogs(shipment.files, cursors, limit=20)] == ['10:00:06 web6']
+    assert [line for _, _, line in entities.collectlogs(shipment.files, cursors, limit=20)] == ['10:00:07 web7']
+
+    # lines of files without format have no time
+    assert entities.LogFile().gettime('10:00:08 web8') is None
+    assert entities.LogFile('%H:%M:%S').gettime('10:00:08 web8') == datetime.datetime(1900, 1, 1, 10, 0, 8)
+
+
+def test_make_backrefs_sharing(make_shipment):
+    template = entities.TemplateFile('${this.name}', values={'key': 'value'})
+    config = entities.ConfigVolume(dest='/etc/app', files={'app.conf': template})
+    shipment = make_shipment('web', 'db', env={'A': '1'}, volumes={'config': config})
+    web, db = shipment.containers
+    assert [file.data for file in shipment.files] == ['web', 'db']
+    assert web.volumes['config'].container is web and db.volumes['config'].container is db
+    # only objects which need own backrefs are copied
+    assert web.volumes['config'].files['app.conf'] is not db.volumes['config'].files['app.conf']
+    assert web.volumes['config'].files['app.conf'].context is db.volumes['config'].files['app.conf'].context
+
+
+def test_compact_entities(make_shipment):
+    import copy
+    import pickle
+    import yaml
+
+    volume = entities.ConfigVolume('/etc', {'a.conf': entities.TextFile('a')})
+    # ship with docker client can't be pickled
+    shipment = make_shipment(ship=entities.Ship('ship1', 'ship1.example.com'),
+                             doors={'http': entities.Door('http')}, volumes={'config': volume})
+    container = next(shipment.containers)
+    assert not hasattr(container, '__dict__')
+    # attributes not declared in slots are kept in extra
+    container.links = ['db']
+    assert container.extra == {'links': ['db']}
+    with pytest.raises(AttributeError):
+        container.volumes['config'].ro = False
+
+    # state is restored without state setter or __setstate__, which older pythons and PyYAML don't support
+    assert len(container.__reduce_ex__(2)) == 3
+    for loaded in [pickle.loads(pickle.dumps(shipment, 2)), pickle.loads(pickle.dumps(shipment)),
+                   copy.deepcopy(shipment), yaml.load(yaml.dump(shipment), Loader=yaml.Loader)]:
+        web = loaded.ships['ship1'].containers['web']
+        assert web.links == ['db']
+        assert web.doors['http'].container is web
+        assert web.volumes['config'].files['a.conf'].volume.container is web
+        assert web.volumes['config'].files['a.conf'].data == 'a'
+
+    # old documents with per-object dict state are still loaded
+    door = yaml.load('!!python/object:dominator.entities.Door {schema: http, port: 80, paths: [/]}', Loader=yaml.Loader)
+    assert door.port == 80 and door.paths == ['/']
+
+
+def test_localship_certificate(tmpdir, monkeypatch, settings):
+    settings['cachedir'] = str(tmpdir)
+    generated = []
+
+    def generate_certificate():
+        generated.append(True)
+        return 'certificate'
+    monkeypatch.setattr(entities, 'generate_certificate', generate_certificate)
+
+    # certificate is generated on first access only and then is loaded from cache
+    ship = entities.LocalShip()
+    assert generated == []
+    assert ship.certificate == 'certificate'
+    assert entities.LocalShip().certificate == 'certificate'
+    assert len(generated) == 1
+
+
+def test_file_rendered(make_shipment):
+    import copy
+    import hashlib
+
+    renders = []
+
+    def render(value):
+        renders.append(value)
+        return value
+    template = entities.TemplateFile('${render(this.name)} ${values["key"]}', render=render, values={'key': 'a'})
+    config = entities.ConfigVolume(dest='/etc/app', files={'app.conf': template})
+    shipment = make_shipment('web', 'db', volumes={'config': config})
+    web, db = [container.volumes['config'].files['app.conf'] for container in shipment.containers]
+
+    # every copy of shared file is rendered once for its own container
+    assert (web.rendered, web.size, web.digest) == (b'web a', 5, hashlib.sha256(b'web a').hexdigest())
+    assert web.rendered == b'web a' and db.rendered == b'db a'
+    assert renders == ['web', 'db']
+    # rendered contents are neither saved nor copied
+    assert '_rendered' not in web.__getstate__()
+    assert copy.copy(web).render() is not web.render()
+
+    # context changed in place needs explicit invalidation, assigned one doesn't
+    web.context['values']['key'] = 'b'
+    assert web.rendered == b'web a'
+    web.invalidate()
+    assert web.rendered == b'web b'
+    web.context = dict(web.context, values={'key': 'c'})
+    assert web.rendered == b'web c'
@@ -0,0 +1,143 @@
+import pytest
+
+from dominator import entities
+from dominator import utils
+
+
+def test_compare_definitions(make_shipment):
+    def make_container(env, text):
+        return next(make_shipment(env=env, volumes={
+            'config': entities.ConfigVolume(dest='/etc/web', files={'web.conf': entities.TextFile(text)})}).containers)
+
+    old = make_container({'A': '1', 'B': '2'}, 'line1\nline2')
+    new = make_container({'A': '1', 'C': '3'}, 'line1\nother')
+    assert utils.compare_definitions(old, old) == []
+    assert utils.compare_definitions(old, new) == [
+        (('env', 'B'), ('', '2')),
+        (('env', 'C'), ('3', '')),
+        (('volumes', '/etc/web', 'files', 'web.conf'), ['- line2', '+ other']),
+    ]
+
+
+def test_compare_ports_and_volumes(make_shipment):
+    container = next(make_shipment(
+        ship=entities.Ship('ship1', 'ship1.example.com', datadir='/data'),
+        doors={'http': entities.Door('http', externalport=8080), 'ftp': entities.Door('ftp')},
+        volumes={'data': entities.DataVolume('/data'), 'logs': entities.DataVolume('/logs', path='/var/log/web')},
+    ).containers)
+
+    assert utils.compare_ports(container, {
+        '80/tcp': [{'HostPort': '8081'}],
+        '22/tcp': [{'HostPort': '22'}],
+    }) == [
+        (('ports', 'http', 'ext'), (8080, 8081)),
+        (('ports',), ('ftp', '')),
+        (('ports',), ('', '22')),
+    ]
+    assert utils.compare_volumes(container, {
+        'Volumes': {'/data': '/data/testshipment/web/data', '/tmp': '/tmp', '/var': '/var/lib/docker/vfs/dir/1'},
+        'VolumesRW': {'/data': False, '/tmp': True, '/var': True},
+    }) == [
+        (('volumes', '/data', 'ro'), (False, True)),
+        (('volumes',), ('', '/tmp')),
+        (('volumes',), ('/logs', '')),
+    ]
+
+
+def test_difftext():
+    assert utils.difftext('a\nb\nc', 'a\nd\nc') == ['- b', '+ d']
+
+    actual = '\n'.join(str(i) for i in range(1000))
+    expected = actual.replace('500', 'five hundred')
+    assert utils.difftext(actual, expected) == ['? @@ -501 +501 @@', '- 500', '+ five hundred']
+
+    expected = '\n'.join(str(i) for i in range(1000, 2000))
+    assert len(utils.difftext(actual, expected, maxlines=10)) == 11
+
+
+def test_workqueue():
+    queue = utils.WorkQueue()
+    queue.put('a')
+    queue.put('b')
+    queue.put('a')
+    assert len(queue) == 2
+
+    item, _ = queue.get()
+    assert item == 'a'
+    # item put while being processed is queued again after it is done
+    queue.put('a')
+    assert len(queue) == 1
+    queue.done('a')
+    assert [queue.get()[0] for _ in range(2)] == ['b', 'a']
+    assert len(queue) == 0
+
+
+def test_docker_lines():
+    records = [b'first\nsec', b'ond', b'\n\xd0', b'\xb0\nlast']
+    assert list(utils.docker_lines(records)) == ['first', 'second', 'а', 'last']
+    assert list(utils.docker_lines([b'a\n', b'\n', b'b\n'])) == ['a', '', 'b']
+
+
+def test_nameindex():
+    class Named:
+        def __init__(self, fullname):
+            self.fullname = fullname
+
+    names = ['web1:nginx', 'db:postgres', 'web2:nginx', 'web1:app', 'webby:app']
+    index = utils.NameIndex(Named(name) for name in names)
+    assert [o.fullname for o in index.filter('web?:*')] == ['web1:app', 'web1:nginx', 'web2:nginx']
+    assert [o.fullname for o in index.filter('*:nginx')] == ['web1:nginx', 'web2:nginx']
+    assert [o.fullname for o in index.filter('db:postgres')] == ['db:postgres']
+    assert [o.fullname for o in index.filter('web1')] == []
+    assert [o.fullname for o in index.filter('web[0-9]:a', regex=True)] == ['web1:app']
+
+
+def test_segmentindex():
+    class Named:
+        def __init__(self, fullname):
+            self.fullname = fullname
+
+    built = []
+
+    def segment(name, *names):
+        def objects():
+            built.append(name)
+            return [Named('{}:{}'.format(name, other)) for other in names]
+        return objects
+
+    index = utils.SegmentIndex({name: segment(name, 'nginx', 'app') for name in ['web1', 'web10', 'db']})
+    assert [o.fullname for o in index.filter('web1:*')] == ['web1:app', 'web1:nginx']
+    assert built == ['web1']
+    assert [o.fullname for o in index.filter('web1*:app')] == ['web10:app', 'web1:app']
+    assert [o.fullname for o in index.filter('*:nginx')] == ['db:nginx', 'web10:nginx', 'web1:nginx']
+    assert [o.fullname for o in index.filter('.*0:a', regex=True)] == ['web10:app']
+    assert sorted(built) == ['db', 'web1', 'web10']
+
+
+def test_template_cache(tmpdir, settings):
+    cache = utils.TemplateCache()
+    template = cache.get('${x}!')
+    assert cache.get('${x}!') is template
+    assert template.render(x=1) == '1!'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # compiled modules are kept in templatedir and reused by other processes
+    settings['templatedir'] = str(tmpdir)
+    assert cache.get('${x}?').render(x=2) == '2?'
+    assert len(tmpdir.listdir('*.py')) == 1
+    assert utils.TemplateCache().get('${x}?').render(x=3) == '3?'
+
+
+def test_atomicwrite(tmpdir):
+    path = tmpdir.join('dir', 'file')
+    with utils.atomicwrite(str(path)) as f:
+        f.write('old')
+    assert path.read() == 'old'
+
+    # failed write leaves neither partial file nor temporary one
+    with pytest.raises(ZeroDivisionError):
+        with utils.atomicwrite(str(path)) as f:
+            f.write('new')
+            1 / 0
+    assert path.read() == 'old'
+    assert path.dirpath().listdir() == [path]